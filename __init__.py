@@ -1,6 +1,7 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
+from . import company
 from . import cron
 from . import invoice
 from . import party
@@ -17,9 +18,14 @@ def register():
         account.Tax,
         account.FiscalYear,
         account.Period,
+        company.Company,
         cron.Cron,
         party.Party,
+        party.PartyIdentifier,
         invoice.Verifactu,
+        invoice.VerifactuChain,
+        invoice.VerifactuLease,
+        invoice.VerifactuRun,
         invoice.Invoice,
         module='aeat_verifactu', type_='model')
     Pool.register(
@@ -8,6 +8,8 @@ from trytond.pool import Pool, PoolMeta
 from trytond.modules.company.model import CompanyValueMixin
 from trytond.exceptions import UserWarning
 
+from .invoice import period_send_invoices_cache
+
 # Desglose -> DetalleDesglose -> ClaveRegimen
 SEND_SPECIAL_REGIME_KEY = [  # L8A
     (None, ''),
@@ -155,6 +157,22 @@ class FiscalYear(metaclass=PoolMeta):
                 p for p in fiscalyear.periods if p.type == 'standard')
         Period.write(periods, {name: value})
 
+    @classmethod
+    def create(cls, vlist):
+        fiscalyears = super().create(vlist)
+        period_send_invoices_cache.clear()
+        return fiscalyears
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        period_send_invoices_cache.clear()
+
+    @classmethod
+    def delete(cls, fiscalyears):
+        super().delete(fiscalyears)
+        period_send_invoices_cache.clear()
+
 
 class RenewFiscalYear(metaclass=PoolMeta):
     __name__ = 'account.fiscalyear.renew'
@@ -191,6 +209,18 @@ class Period(metaclass=PoolMeta):
                         to_check.append(period)
         cls.check_es_verifactu_posted_invoices(to_check)
         super().write(*args)
+        period_send_invoices_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        periods = super().create(vlist)
+        period_send_invoices_cache.clear()
+        return periods
+
+    @classmethod
+    def delete(cls, periods):
+        super().delete(periods)
+        period_send_invoices_cache.clear()
 
     @classmethod
     def check_es_verifactu_posted_invoices(cls, periods):
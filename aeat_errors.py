@@ -117,3 +117,28 @@ AEAT_ERRORS = [
     ('2009', "Do not enter the field PaymentCompensationREAGYP if the field KeyRegimenSpecialTrading on invoices received has a value other than 02"),
     ('2011', "Counterpart NIF is not in the Census"),
     ]
+
+# Errors that are not solved by sending the record again
+DUPLICATE_ERRORS = {
+    '3000',  # Duplicate Invoice
+    }
+CANCELLED_ERRORS = {
+    '3001',  # Registration is already unsubscribed
+    }
+NOT_FOUND_ERRORS = {
+    '3002',  # There is no record
+    }
+PERMANENT_ERRORS = DUPLICATE_ERRORS | CANCELLED_ERRORS | NOT_FOUND_ERRORS
+
+# Code of the permanent errors recognized by the message of the records
+# rejected before their code was stored
+PERMANENT_MESSAGES = [
+    ('%duplicad%', '3000'),
+    ('%dado de baja%', '3001'),
+    ('%no existe%', '3002'),
+    ]
+
+
+def is_retryable(code):
+    "Return if a record rejected with the error code can be sent again"
+    return code not in PERMANENT_ERRORS
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Measure the time needed to build the Verifactu records of posted invoices
+with and without the batch prefetch.
+
+    python benchmark/build.py -c trytond.conf -d DATABASE --company 1
+"""
+import argparse
+import time
+
+
+def main(database, company, limit, config_file=None):
+    from trytond import config
+    config.update_etc(config_file)
+
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Pool.start()
+    pool = Pool(database)
+    pool.init()
+
+    results = {}
+    # Each variant runs in its own transaction to start with an empty cache
+    for name in ['lazy', 'prefetch']:
+        with Transaction().start(database, 0, readonly=True,
+                context={'company': company}):
+            Invoice = pool.get('account.invoice')
+            invoices = Invoice.search([
+                    ('company', '=', company),
+                    ('type', '=', 'out'),
+                    ('state', 'in', ['posted', 'paid']),
+                    ('is_verifactu', '=', True),
+                    ], limit=limit, order=[('number', 'ASC'), ('id', 'ASC')])
+            if not invoices:
+                print("No posted Verifactu invoices found")
+                return
+            start = time.perf_counter()
+            if name == 'prefetch':
+                Invoice.build_verifactu_records(invoices,
+                    prefetched=Invoice.verifactu_prefetch(invoices))
+            else:
+                Invoice.build_verifactu_records(invoices)
+            results[name] = time.perf_counter() - start
+
+    print("%s invoices" % len(invoices))
+    for name, duration in results.items():
+        print("%-10s %8.3f s total %8.3f s per 1000 invoices" % (
+                name, duration, duration * 1000 / len(invoices)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--config', dest='config_file')
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--company', type=int, required=True)
+    parser.add_argument('-n', '--limit', type=int, default=1000,
+        help="number of invoices to build (default: %(default)s)")
+    args = parser.parse_args()
+    main(args.database, args.company, args.limit, args.config_file)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Compare the sequential, threaded and asyncio dispatch of send_verifactu for
+several companies against the local stand-in of the AEAT service.
+
+The companies must be prepared as for benchmark/send.py. The invoices are
+seeded again before each mode as the dispatch commits the sending.
+
+    python benchmark/dispatch.py -c trytond.conf -d DATABASE \\
+        --company 1 --company 2 --company 3 \\
+        -n 500 --latency 0.5
+"""
+import argparse
+import datetime
+import json
+import platform
+import time
+
+from send import MIX, seed
+
+MODES = ['sequential', 'threads', 'async']
+
+
+def main(database, companies, number, wsdl_directory, modes, workers=4,
+        latency=0, output=None, config_file=None):
+    from trytond import config
+    config.update_etc(config_file)
+
+    from trytond.modules.aeat_verifactu.tests import verifactu_server
+    # The wait time is disabled to send the seeded invoices of each mode
+    server = verifactu_server.start(
+        wsdl_directory or verifactu_server.DIRECTORY, latency=latency, wait=0)
+    if not config.has_section('aeat_verifactu'):
+        config.add_section('aeat_verifactu')
+    config.set('aeat_verifactu', 'wsdl',
+        server.url + 'SistemaFacturacion.wsdl')
+
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Pool.start()
+    pool = Pool(database)
+    pool.init()
+
+    results = {}
+    for mode in modes:
+        for company in companies:
+            seed(database, company, number, MIX)
+        config.set('aeat_verifactu', 'dispatch_workers',
+            str(1 if mode == 'sequential' else workers))
+        calls = sum(server.calls.values())
+        with Transaction().start(database, 0):
+            Invoice = pool.get('account.invoice')
+            start = time.perf_counter()
+            if mode == 'async':
+                Invoice.send_verifactu_companies_async(companies)
+            else:
+                Invoice.send_verifactu_companies(companies)
+            duration = time.perf_counter() - start
+        results[mode] = {
+            'seconds': duration,
+            'soap_calls': sum(server.calls.values()) - calls,
+            }
+    server.shutdown()
+
+    content = json.dumps({
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'companies': len(companies),
+            'invoices_by_company': number,
+            'workers': workers,
+            'latency': latency,
+            'modes': results,
+            }, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(content + '\n')
+    else:
+        print(content)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--config', dest='config_file')
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--company', dest='companies', type=int,
+        action='append', required=True)
+    parser.add_argument('--wsdl-directory',
+        help="WSDL served by the stand-in (default: tests/wsdl)")
+    parser.add_argument('-n', '--number', type=int, default=100,
+        help="number of invoices to seed by company (default: %(default)s)")
+    parser.add_argument('--mode', dest='modes', choices=MODES,
+        action='append', help="modes to run (default: all)")
+    parser.add_argument('--workers', type=int, default=4,
+        help="threads of the threaded mode (default: %(default)s)")
+    parser.add_argument('--latency', type=float, default=0,
+        help="seconds added by the stand-in to each request")
+    parser.add_argument('-o', '--output',
+        help="file to write the JSON result, default to the standard output")
+    args = parser.parse_args()
+    main(args.database, args.companies, args.number, args.wsdl_directory,
+        args.modes or MODES, workers=args.workers, latency=args.latency,
+        output=args.output, config_file=args.config_file)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Seed synthetic posted invoices and measure send_verifactu against the local
+stand-in of the AEAT service (tests/verifactu_server.py).
+
+The database must have the module activated and a company with the Spanish
+chart of accounts, a fiscal year with Verifactu enabled and a Verifactu
+certificate. The benchmark is run with:
+
+    python benchmark/send.py -c trytond.conf -d DATABASE --company 1 \\
+        -n 5000 -o result.json
+
+The stand-in serves the reduced WSDL of tests/wsdl unless --wsdl-directory
+points to the AEAT one downloaded with:
+
+    python tests/verifactu_server.py fetch WSDL_DIRECTORY
+
+The result is written as JSON with the duration and number of calls of each
+stage. The fingerprint is computed during the build so its time is also
+included in the build stage. Each batch sent is committed by send_verifactu
+so the seeded invoices are left sent.
+"""
+import argparse
+import datetime
+import inspect
+import json
+import platform
+import sys
+import time
+from collections import defaultdict
+from decimal import Decimal
+
+# Mix of invoices seeded by default
+MIX = {
+    'standard': 4,
+    'simplified': 3,
+    'surcharge': 1,
+    'exempt': 1,
+    'intracommunity': 1,
+    }
+# Stages measured by wrapping the methods of account.invoice
+STAGES = {
+    'search': 'search',
+    'service': 'verifactu_service',
+    'chain': 'get_batch_start_verifactu_info',
+    'prefetch': 'verifactu_prefetch',
+    'build': 'build_verifactu_records',
+    'fingerprint': 'verifactu_fingerprint',
+    'submit': 'verifactu_submit_records',
+    'save': 'save_verifactu_responses',
+    }
+
+
+def get_taxes(company):
+    "Return the taxes to use for each kind of invoice of the mix"
+    from trytond.pool import Pool
+    pool = Pool()
+    Tax = pool.get('account.tax')
+
+    domain = [
+        ('company', '=', company),
+        ('parent', '=', None),
+        ('tax_kind', '=', 'vat'),
+        ]
+    standard = Tax.search(domain + [
+            ('verifactu_subjected_key', '=', 'S1'),
+            ('recargo_equivalencia_related_tax', '=', None),
+            ('rate', '=', Decimal('0.21')),
+            ], limit=1)
+    surcharge = Tax.search(domain + [
+            ('verifactu_subjected_key', '=', 'S1'),
+            ('recargo_equivalencia_related_tax', '!=', None),
+            ], limit=1)
+    exempt = Tax.search(domain + [
+            ('verifactu_exemption_cause', '=', 'E1'),
+            ], limit=1)
+    intracommunity = Tax.search(domain + [
+            ('verifactu_exemption_cause', '=', 'E5'),
+            ], limit=1)
+    taxes = {
+        'standard': standard,
+        'simplified': standard,
+        'surcharge': surcharge and (
+            surcharge + [surcharge[0].recargo_equivalencia_related_tax]),
+        'exempt': exempt,
+        'intracommunity': intracommunity,
+        }
+    for kind, kind_taxes in taxes.items():
+        if not kind_taxes:
+            sys.exit("No tax found for %s invoices" % kind)
+    return taxes
+
+
+def get_parties():
+    "Return the customer to use for each kind of invoice of the mix"
+    from trytond.pool import Pool
+    pool = Pool()
+    Party = pool.get('party.party')
+
+    def party(name, code=None, identifier_type=None):
+        parties = Party.search([('name', '=', name)], limit=1)
+        if parties:
+            return parties[0]
+        party = Party(name=name, verifactu_identifier_type=identifier_type,
+            addresses=[{}])
+        if code:
+            party.identifiers = [{'type': 'eu_vat', 'code': code}]
+        party.save()
+        return party
+
+    national = party("Verifactu Benchmark, S.L.", 'ESB65247983')
+    return {
+        'standard': national,
+        'simplified': party("Verifactu Benchmark Simplified", None, 'SI'),
+        'surcharge': national,
+        'exempt': national,
+        'intracommunity': party("Verifactu Benchmark SARL", 'FR40303265045',
+            '02'),
+        }
+
+
+def seed(database, company, number, mix):
+    "Create and post number invoices following mix"
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    pool = Pool(database)
+    kinds = [k for k, w in mix.items() for _ in range(w)]
+    with Transaction().start(database, 0, context={'company': company}):
+        Account = pool.get('account.account')
+        Invoice = pool.get('account.invoice')
+        Journal = pool.get('account.journal')
+
+        revenue, = Account.search([
+                ('company', '=', company),
+                ('type.revenue', '=', True),
+                ('closed', '!=', True),
+                ], limit=1)
+        journal, = Journal.search([('type', '=', 'revenue')], limit=1)
+        taxes = get_taxes(company)
+        parties = get_parties()
+
+        invoices = []
+        today = datetime.date.today()
+        for i in range(number):
+            kind = kinds[i % len(kinds)]
+            party = parties[kind]
+            invoices.append(Invoice(
+                    company=company,
+                    type='out',
+                    journal=journal,
+                    party=party,
+                    invoice_address=party.address_get(type='invoice'),
+                    account=party.account_receivable_used,
+                    invoice_date=today,
+                    description="Verifactu benchmark %s" % kind,
+                    lines=[{
+                            'account': revenue,
+                            'description': "Line %s" % i,
+                            'quantity': 1 + i % 5,
+                            'unit_price': Decimal('10.00') + i % 100,
+                            'taxes': taxes[kind],
+                            }],
+                    ))
+        Invoice.save(invoices)
+        Invoice.post(invoices)
+    return number
+
+
+class Timers:
+    "Wrap methods of a class to accumulate the time spent in them"
+
+    def __init__(self, cls, stages):
+        self.cls = cls
+        self.stages = stages
+        self.durations = defaultdict(float)
+        self.calls = defaultdict(int)
+        self._originals = {}
+
+    def _wrap(self, stage, function):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.durations[stage] += time.perf_counter() - start
+                self.calls[stage] += 1
+        return wrapper
+
+    def __enter__(self):
+        for stage, name in self.stages.items():
+            original = inspect.getattr_static(self.cls, name)
+            self._originals[name] = self.cls.__dict__.get(name)
+            if isinstance(original, (staticmethod, classmethod)):
+                wrapped = type(original)(
+                    self._wrap(stage, original.__func__))
+            else:
+                wrapped = self._wrap(stage, original)
+            setattr(self.cls, name, wrapped)
+        return self
+
+    def __exit__(self, *exc):
+        for name, original in self._originals.items():
+            if original is None:
+                delattr(self.cls, name)
+            else:
+                setattr(self.cls, name, original)
+
+
+def main(database, company, number, wsdl_directory, mix, batch_size=None,
+        latency=0, error_rate=0, output=None, config_file=None):
+    from trytond import config
+    config.update_etc(config_file)
+
+    from trytond.modules.aeat_verifactu.tests import verifactu_server
+    # The wait time is disabled to send all the seeded invoices instead of
+    # deferring the batches after the first partial one
+    server = verifactu_server.start(
+        wsdl_directory or verifactu_server.DIRECTORY, latency=latency,
+        error_rate=error_rate, wait=0)
+    if not config.has_section('aeat_verifactu'):
+        config.add_section('aeat_verifactu')
+    config.set('aeat_verifactu', 'wsdl',
+        server.url + 'SistemaFacturacion.wsdl')
+    if batch_size:
+        config.set('aeat_verifactu', 'batch_size', str(batch_size))
+
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Pool.start()
+    pool = Pool(database)
+    pool.init()
+
+    start = time.perf_counter()
+    seed(database, company, number, mix)
+    seed_duration = time.perf_counter() - start
+
+    with Transaction().start(database, 0, context={'company': company}):
+        Invoice = pool.get('account.invoice')
+        with Timers(Invoice, STAGES) as timers:
+            start = time.perf_counter()
+            Invoice.send_verifactu()
+            duration = time.perf_counter() - start
+
+    result = {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'invoices': number,
+        'mix': mix,
+        'batch_size': batch_size,
+        'latency': latency,
+        'error_rate': error_rate,
+        'seed': seed_duration,
+        'total': duration,
+        'per_1000': duration * 1000 / number if number else None,
+        'soap_calls': dict(server.calls),
+        'stages': {
+            stage: {
+                'calls': timers.calls[stage],
+                'seconds': timers.durations[stage],
+                }
+            for stage in STAGES},
+        }
+    server.shutdown()
+    content = json.dumps(result, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(content + '\n')
+    else:
+        print(content)
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        kind, weight = item.split('=')
+        if kind not in MIX:
+            raise argparse.ArgumentTypeError("Unknown invoice kind %s" % kind)
+        mix[kind] = int(weight)
+    return mix
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--config', dest='config_file')
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--company', type=int, required=True)
+    parser.add_argument('--wsdl-directory',
+        help="WSDL served by the stand-in (default: tests/wsdl)")
+    parser.add_argument('-n', '--number', type=int, default=1000,
+        help="number of invoices to seed (default: %(default)s)")
+    parser.add_argument('--mix', type=parse_mix, default=MIX,
+        help="weight of each kind of invoice as kind=weight,... "
+        "(default: %s)" % ','.join('%s=%s' % i for i in MIX.items()))
+    parser.add_argument('--batch-size', type=int)
+    parser.add_argument('--latency', type=float, default=0,
+        help="seconds added by the stand-in to each request")
+    parser.add_argument('--error-rate', type=float, default=0,
+        help="ratio of records rejected by the stand-in")
+    parser.add_argument('-o', '--output',
+        help="file to write the JSON result, default to the standard output")
+    args = parser.parse_args()
+    main(args.database, args.company, args.number, args.wsdl_directory,
+        args.mix, batch_size=args.batch_size, latency=args.latency,
+        error_rate=args.error_rate, output=args.output,
+        config_file=args.config_file)
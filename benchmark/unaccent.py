@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Compare tools.unaccent with the previous loop based implementation.
+
+    python benchmark/unaccent.py
+"""
+import argparse
+import timeit
+import unicodedata
+
+from trytond.modules.aeat_verifactu import tools
+
+TEXTS = [
+    'Comercial Ñandú, S.A.',
+    'Distribucions Àngel Pérez i Fills, S.L.',
+    'Factura de serveis: manteniment [gener] #12',
+    'Plain ASCII customer name',
+    'Ferretería García & Hijos / Almacén ¿2?',
+    ]
+
+
+def loop_unaccent(text):
+    output = text
+    for c in range(len(tools.src_chars)):
+        if c >= len(tools.dst_chars):
+            break
+        output = output.replace(tools.src_chars[c], tools.dst_chars[c])
+    output = unicodedata.normalize('NFKD', output).encode('ASCII',
+        'ignore')
+    return output.replace(b"_", b"").decode('ASCII')
+
+
+def main(number, distinct):
+    # Many distinct names defeat the cache, few distinct names use it
+    texts = ['%s %s' % (TEXTS[i % len(TEXTS)], i % distinct)
+        for i in range(number)]
+
+    def uncached():
+        tools.unaccent.cache_clear()
+        for text in texts:
+            tools.unaccent.__wrapped__(text)
+
+    benchmarks = [
+        ('loop', lambda: [loop_unaccent(t) for t in texts]),
+        ('table', uncached),
+        ('table+cache', lambda: [tools.unaccent(t) for t in texts]),
+        ('unaccent_many', lambda: tools.unaccent_many(texts)),
+        ]
+    print("%s texts, %s distinct" % (number, min(number, distinct)))
+    for name, function in benchmarks:
+        duration = min(timeit.repeat(function, number=1, repeat=5))
+        print("%-15s %8.3f ms" % (name, duration * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--number', type=int, default=100000)
+    parser.add_argument('--distinct', type=int, default=1000)
+    args = parser.parse_args()
+    main(args.number, args.distinct)
@@ -0,0 +1,27 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+from .invoice import sistema_informatico_cache, headers_cache
+
+
+class Company(metaclass=PoolMeta):
+    __name__ = 'company.company'
+
+    @classmethod
+    def create(cls, vlist):
+        companies = super().create(vlist)
+        sistema_informatico_cache.clear()
+        headers_cache.clear()
+        return companies
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        headers_cache.clear()
+
+    @classmethod
+    def delete(cls, companies):
+        super().delete(companies)
+        sistema_informatico_cache.clear()
+        headers_cache.clear()
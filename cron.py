@@ -1,6 +1,13 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from trytond.pool import  PoolMeta
+from trytond.model import ModelView, dualmethod
+from trytond.pool import Pool, PoolMeta
+
+# Methods dispatching the send of several companies by themselves
+DISPATCH_METHODS = {
+    'account.invoice|send_verifactu_companies',
+    'account.invoice|send_verifactu_companies_async',
+    }
 
 
 class Cron(metaclass=PoolMeta):
@@ -11,4 +18,26 @@ class Cron(metaclass=PoolMeta):
         super().__setup__()
         cls.method.selection.extend([
                 ('account.invoice|send_verifactu', "AEAT Verifactu"),
+                ('account.invoice|send_verifactu_companies',
+                    "AEAT Verifactu (All Companies)"),
+                ('account.invoice|send_verifactu_companies_async',
+                    "AEAT Verifactu (All Companies, Asyncio)"),
                 ])
+        cls.methods_company_needed |= DISPATCH_METHODS
+
+    @dualmethod
+    @ModelView.button
+    def run_once(cls, crons):
+        pool = Pool()
+        others = []
+        for cron in crons:
+            if cron.method in DISPATCH_METHODS and cron.companies:
+                # The companies are dispatched at once instead of running
+                # the cron for each one
+                model, method = cron.method.split('|')
+                Model = pool.get(model)
+                getattr(Model, method)(list(map(int, cron.companies)))
+            else:
+                others.append(cron)
+        if others:
+            super().run_once(others)
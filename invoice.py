@@ -1,6 +1,16 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import asyncio
+import contextvars
+import logging
+import os
+import socket
+import ssl
 import time
+import threading
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 import datetime
 import hashlib
@@ -8,26 +18,34 @@ from types import SimpleNamespace
 import pytz
 from sql import Literal, Null
 from sql.aggregate import Max
-from sql.functions import Substring
-from sql.conditionals import Case, Coalesce
-from requests import Session
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp, Lower
 from urllib.parse import urlencode
-from zeep import Client
-from zeep.transports import Transport
+from zeep import AsyncClient, Client
+from zeep.cache import SqliteCache
+from zeep.transports import AsyncTransport, Transport
 from zeep.settings import Settings
+from zeep.wsdl import Document
 from zeep.plugins import HistoryPlugin
 
 import trytond
 import trytond.config as config
-from trytond.model import ModelSQL, ModelView, fields
+from trytond import backend
+from trytond.model import Index, ModelSQL, ModelView, Unique, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Bool, Eval
-from trytond.transaction import Transaction
+from trytond.transaction import Transaction, without_check_access
+from trytond.cache import Cache, LRUDict
 from trytond.i18n import gettext
 from trytond.exceptions import UserError, UserWarning
-from trytond.tools import grouped_slice
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.modules.account.exceptions import PeriodNotFoundError
-from . import tools
+from . import aeat_errors, metrics, tools
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 PRODUCTION_QR_URL = "https://www2.agenciatributaria.gob.es/wlpl/TIKE-CONT/ValidarQR"
 TEST_QR_URL = "https://prewww2.aeat.es/wlpl/TIKE-CONT/ValidarQR"
@@ -37,6 +55,20 @@ PRODUCTION_ENV = config.getboolean('database', 'production', default=False)
 WSDL_PROD = 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tikeV1.0/cont/ws/'
 WSDL_TEST = 'https://prewww2.aeat.es/static_files/common/internet/dep/aplicaciones/es/aeat/tikeV1.0/cont/ws/'
 
+# Maximum number of RegistroFactura accepted by AEAT in a single request
+MAX_RECORDS = 1000
+# Name of the queue of the sends triggered by the posting of invoices
+VERIFACTU_QUEUE = 'verifactu'
+
+# zeep clients by WSDL, port and certificate shared by the whole process
+_clients = LRUDict(config.getint('aeat_verifactu', 'client_cache_size',
+        default=16))
+_clients_lock = threading.Lock()
+# Parsed WSDL by URL from which the sync and asyncio clients are created
+_documents = {}
+
+logger = logging.getLogger(__name__)
+
 VERSION = trytond.__version__
 VERSION = '.'.join(VERSION.split('.')[:2])
 
@@ -66,15 +98,78 @@ OPERATION_KEY = [ # L2
     ]
 
 
+# Both caches are cleared when companies, their parties or identifiers change
+sistema_informatico_cache = Cache('aeat_verifactu.sistema_informatico',
+    context=False)
+headers_cache = Cache('aeat_verifactu.headers', context=False)
+# Send invoices flag of the period of each company and date, cleared when
+# periods or fiscal years change
+period_send_invoices_cache = Cache('aeat_verifactu.period_send_invoices',
+    context=False)
+
+
+def get_wsdl():
+    "Return the WSDL URL and the port name of the Verifactu service"
+    if PRODUCTION_ENV:
+        wsdl = WSDL_PROD
+        port_name = 'SistemaVerifactu'
+    else:
+        wsdl = WSDL_TEST
+        port_name = 'SistemaVerifactuPruebas'
+
+    wsdl += 'SistemaFacturacion.wsdl'
+    # Allow to target a local stand-in like tests/verifactu_server.py
+    wsdl = config.get('aeat_verifactu', 'wsdl') or wsdl
+    return wsdl, port_name
+
+
+def get_wsdl_document():
+    "Return the parsed WSDL of the Verifactu service shared by all clients"
+    wsdl, _ = get_wsdl()
+    with _clients_lock:
+        document = _documents.get(wsdl)
+    if document is None:
+        transport = Transport(cache=get_wsdl_cache())
+        for retry in range(3):
+            try:
+                document = Document(wsdl, transport,
+                    settings=Settings(forbid_entities=False))
+                break
+            except Exception as e:
+                if retry < 2:
+                    metrics.incr('wsdl_retries')
+                    time.sleep(2 ** retry)
+                    continue
+                raise UserError(str(e))
+        with _clients_lock:
+            _documents[wsdl] = document
+    return document
+
+
+def get_wsdl_cache():
+    cache_path = config.get('aeat_verifactu', 'wsdl_cache')
+    if cache_path:
+        return SqliteCache(path=cache_path,
+            timeout=config.getint(
+                'aeat_verifactu', 'wsdl_cache_timeout', default=None))
+
+
 def get_sistema_informatico():
     pool = Pool()
     Company = pool.get('company.company')
 
+    sistema_informatico = sistema_informatico_cache.get(None)
+    if sistema_informatico is not None:
+        return dict(sistema_informatico)
+
     # TODO: We should check if the other companies are Spanish
     # and/or should be counted
-    companies = Company.search([], count=True)
+    # The block is shared by all the users so the companies are counted
+    # without the record rules of the current one
+    with without_check_access():
+        companies = Company.search([], count=True)
 
-    return {
+    sistema_informatico = {
         'NombreRazon': config.get('aeat_verifactu', 'nombre_razon'),
         'NIF': config.get('aeat_verifactu', 'nif'),
         'NombreSistemaInformatico': config.get('aeat_verifactu',
@@ -88,18 +183,43 @@ def get_sistema_informatico():
         'TipoUsoPosibleMultiOT': 'S',
         'IndicadorMultiplesOT': 'S' if companies > 1 else 'N',
         }
+    sistema_informatico_cache.set(None, sistema_informatico)
+    return sistema_informatico
 
 def get_headers(company):
-    return {
-        'IDVersion': '1.0',
-        'ObligadoEmision': {
+    obligado_emision = headers_cache.get(company.id)
+    if obligado_emision is None:
+        obligado_emision = {
             'NombreRazon': tools.unaccent(company.party.name),
             'NIF': company.party.verifactu_vat_code,
             # TODO: NIFRepresentante
-        },
+            }
+        headers_cache.set(company.id, obligado_emision)
+    return {
+        'IDVersion': '1.0',
+        'ObligadoEmision': dict(obligado_emision),
     }
 
 
+class SubmitAsyncTransport(AsyncTransport):
+    '''
+    Asyncio transport of the clients created from the parsed WSDL
+
+    Unlike AsyncTransport, it does not create an httpx client to load the
+    WSDL as it is never loaded by these clients.
+    '''
+
+    def __init__(self, client):
+        self._close_session = False
+        self.cache = None
+        self.wsdl_client = None
+        self.client = client
+        self.logger = logging.getLogger(AsyncTransport.__module__)
+
+    def _load_remote_data(self, url):
+        raise NotImplementedError("The WSDL is already parsed")
+
+
 class Verifactu(ModelSQL, ModelView):
     '''
     AEAT Verifactu
@@ -114,10 +234,45 @@ class Verifactu(ModelSQL, ModelView):
             'Operation Key'), 'get_invoice_operation_key')
     fingerprint = fields.Text('Fingerprint', readonly=True)
     error_message = fields.Char('Error Message', readonly=True)
+    error_code = fields.Char('Error Code', readonly=True,
+        help="The CodigoErrorRegistro returned by AEAT.")
+    error_description = fields.Function(fields.Char('Error Description'),
+        'get_error_description')
+    error_retryable = fields.Function(fields.Boolean('Error Retryable',
+            help="The rejected record can be sent again."),
+        'get_error_retryable', searcher='search_error_retryable')
 
     def get_invoice_operation_key(self, name):
         return self.invoice.verifactu_operation_key if self.invoice else None
 
+    def get_error_description(self, name):
+        if self.error_code:
+            return dict(aeat_errors.AEAT_ERRORS).get(self.error_code)
+
+    def get_error_retryable(self, name):
+        return (self.state == 'Incorrecto'
+            and aeat_errors.is_retryable(self.error_code))
+
+    @classmethod
+    def search_error_retryable(cls, name, clause):
+        _, operator, value = clause
+        if operator not in ('=', '!='):
+            return []
+        permanent = sorted(aeat_errors.PERMANENT_ERRORS)
+        if (operator == '=' and value) or (operator == '!=' and not value):
+            return [
+                ('state', '=', 'Incorrecto'),
+                ['OR',
+                    ('error_code', '=', None),
+                    ('error_code', 'not in', permanent),
+                    ],
+                ]
+        return ['OR',
+            ('state', '!=', 'Incorrecto'),
+            ('state', '=', None),
+            ('error_code', 'in', permanent),
+            ]
+
     @staticmethod
     def default_company():
         return Transaction().context.get('company')
@@ -125,8 +280,31 @@ class Verifactu(ModelSQL, ModelView):
     @classmethod
     def __setup__(cls):
         super().__setup__()
+        t = cls.__table__()
         cls.__access__.add('invoice')
         cls._order = [('id', 'DESC')]
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.invoice, Index.Equality()),
+                    (t.id, Index.Range(order='DESC'))),
+                Index(t, (t.state, Index.Equality(cardinality='low'))),
+                Index(t, (t.error_code, Index.Equality(cardinality='low'))),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        super().__register__(module_name)
+
+        # The permanent errors of the records rejected without code were only
+        # recognized by their message
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        for pattern, code in aeat_errors.PERMANENT_MESSAGES:
+            cursor.execute(*table.update(
+                    [table.error_code], [code],
+                    where=(table.state == 'Incorrecto')
+                    & (table.error_code == Null)
+                    & Lower(table.error_message).like(pattern)))
 
     @classmethod
     def copy(cls, records, default=None):
@@ -137,8 +315,420 @@ class Verifactu(ModelSQL, ModelView):
         default['state'] = None
         default['fingerprint'] = None
         default['error_message'] = None
+        default['error_code'] = None
         return super().copy(records, default=default)
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Chain = pool.get('aeat.verifactu.chain')
+        Invoice = pool.get('account.invoice')
+        records = super().create(vlist)
+        Chain.update_heads(records)
+        Invoice.update_verifactu_last_record(
+            list({r.invoice.id for r in records}))
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        actions = iter(args)
+        invoice_ids = set()
+        for records, values in zip(actions, actions):
+            invoice_ids.update(r.invoice.id for r in records)
+            if values.get('invoice'):
+                invoice_ids.add(values['invoice'])
+        super().write(*args)
+        Invoice.update_verifactu_last_record(list(invoice_ids))
+
+    @classmethod
+    def delete(cls, records):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        invoice_ids = list({r.invoice.id for r in records})
+        super().delete(records)
+        Invoice.update_verifactu_last_record(invoice_ids)
+
+
+class VerifactuChain(ModelSQL):
+    '''
+    AEAT Verifactu Chain
+
+    Last record accepted by AEAT for each issuer, used to chain the next
+    records without querying AEAT, and the time from which AEAT accepts the
+    next submission of the issuer.
+    '''
+    __name__ = 'aeat.verifactu.chain'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE')
+    nif = fields.Char('NIF', required=True)
+    invoice = fields.Many2One('account.invoice', 'Invoice')
+    number = fields.Char('Number')
+    invoice_date = fields.Date('Invoice Date')
+    fingerprint = fields.Text('Fingerprint')
+    next_send = fields.Timestamp('Next Send',
+        help="Incomplete submissions are not sent before this time "
+        "as requested by the TiempoEsperaEnvio of AEAT.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('company_nif_uniq', Unique(t, t.company, t.nif),
+                'aeat_verifactu.msg_verifactu_chain_unique'),
+            ]
+
+    @classmethod
+    def get_head(cls, company, nif):
+        heads = cls.search([
+                ('company', '=', company),
+                ('nif', '=', nif),
+                ], limit=1)
+        if heads:
+            head, = heads
+            return head
+
+    @classmethod
+    def set_head(cls, company, nif, number, invoice_date, fingerprint,
+            invoice=None):
+        values = {
+            'invoice': invoice,
+            'number': number,
+            'invoice_date': invoice_date,
+            'fingerprint': fingerprint,
+            }
+        head = cls.get_head(company, nif)
+        if head:
+            cls.write([head], values)
+        else:
+            values.update({
+                    'company': company,
+                    'nif': nif,
+                    })
+            head, = cls.create([values])
+        return head
+
+    @classmethod
+    def set_next_send(cls, company, nif, next_send):
+        head = cls.get_head(company, nif)
+        if head:
+            cls.write([head], {'next_send': next_send})
+        else:
+            head, = cls.create([{
+                        'company': company,
+                        'nif': nif,
+                        'next_send': next_send,
+                        }])
+        return head
+
+    @classmethod
+    def update_heads(cls, records):
+        heads = {}
+        for record in sorted(records, key=lambda r: r.id):
+            if record.state not in {'Correcto', 'AceptadoConErrores'}:
+                continue
+            invoice = record.invoice
+            nif = invoice.company.party.verifactu_vat_code
+            heads[(invoice.company.id, nif)] = record
+        for (company, nif), record in heads.items():
+            cls.set_head(company, nif, record.invoice.number,
+                record.invoice.invoice_date, record.fingerprint,
+                invoice=record.invoice.id)
+
+    def get_last_line(self):
+        return SimpleNamespace(
+            invoice=SimpleNamespace(
+                company=self.company,
+                number=self.number,
+                invoice_date=self.invoice_date),
+            fingerprint=self.fingerprint)
+
+
+class VerifactuLease(ModelSQL):
+    '''
+    AEAT Verifactu Lease
+
+    Serializes the senders of each issuer across processes and nodes. The
+    lease is taken, renewed and released in short transactions so no lock is
+    kept during the calls to AEAT, and it expires if its owner dies.
+    '''
+    __name__ = 'aeat.verifactu.lease'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE')
+    nif = fields.Char('NIF', required=True)
+    owner = fields.Char('Owner')
+    expires = fields.Timestamp('Expires')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('company_nif_uniq', Unique(t, t.company, t.nif),
+                'aeat_verifactu.msg_verifactu_lease_unique'),
+            ]
+
+    @staticmethod
+    def duration():
+        return datetime.timedelta(seconds=config.getint(
+                'aeat_verifactu', 'lease_duration', default=300))
+
+    @classmethod
+    def acquire(cls, company, nif):
+        """Take the lease of the issuer and return its owner or None if taken
+
+        The lease is taken with a conditional update which does not change
+        the row while another sender holds it, so no lock is needed.
+        """
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        owner = '%s:%s:%s' % (
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        now = datetime.datetime.now()
+        cursor.execute(*table.update(
+                [table.owner, table.expires,
+                    table.write_uid, table.write_date],
+                [owner, now + cls.duration(),
+                    transaction.user, CurrentTimestamp()],
+                where=(table.company == int(company))
+                & (table.nif == nif)
+                & ((table.owner == Null)
+                    | (table.expires == Null)
+                    | (table.expires < now))))
+        if cursor.rowcount:
+            return owner
+        if cls.search([
+                    ('company', '=', company),
+                    ('nif', '=', nif),
+                    ], limit=1):
+            return
+        # Fails on the unique constraint if another sender creates it
+        cls.create([{
+                    'company': company,
+                    'nif': nif,
+                    'owner': owner,
+                    'expires': now + cls.duration(),
+                    }])
+        return owner
+
+    @classmethod
+    def renew(cls, company, nif, owner):
+        "Extend the lease and return False if it is no more owned"
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        cursor.execute(*table.update(
+                [table.expires, table.write_uid, table.write_date],
+                [datetime.datetime.now() + cls.duration(),
+                    transaction.user, CurrentTimestamp()],
+                where=(table.company == int(company))
+                & (table.nif == nif)
+                & (table.owner == owner)))
+        return bool(cursor.rowcount)
+
+    @classmethod
+    def release(cls, company, nif, owner):
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        cursor.execute(*table.update(
+                [table.owner, table.expires,
+                    table.write_uid, table.write_date],
+                [Null, Null, transaction.user, CurrentTimestamp()],
+                where=(table.company == int(company))
+                & (table.nif == nif)
+                & (table.owner == owner)))
+
+    @classmethod
+    def hold(cls, company, nif):
+        """Return the running heartbeat of the lease or None if taken
+
+        The lease is taken in its own transaction so it is visible to the
+        other senders at once.
+        """
+        try:
+            with Transaction().new_transaction() as transaction:
+                owner = cls.acquire(company, nif)
+                transaction.commit()
+        except (backend.DatabaseOperationalError,
+                backend.DatabaseIntegrityError):
+            # Another sender is taking the lease at the same time
+            return
+        if owner:
+            heartbeat = LeaseHeartbeat(company, nif, owner,
+                cls.duration().total_seconds() / 3)
+            heartbeat.start()
+            return heartbeat
+
+
+class LeaseHeartbeat(threading.Thread):
+    "Renew a Verifactu lease until it is released"
+
+    def __init__(self, company, nif, owner, interval):
+        super().__init__(name='verifactu-lease', daemon=True)
+        transaction = Transaction()
+        self.database = transaction.database.name
+        self.user = transaction.user
+        self.context = dict(transaction.context)
+        self.company = int(company)
+        self.nif = nif
+        self.owner = owner
+        self.interval = interval
+        self.lost = False
+        self._stop_event = threading.Event()
+
+    def _call(self, method):
+        "Call method of the lease in its own committed transaction"
+        with Transaction(new=True).start(self.database, self.user,
+                context=self.context):
+            Lease = Pool(self.database).get('aeat.verifactu.lease')
+            return getattr(Lease, method)(self.company, self.nif, self.owner)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                renewed = self._call('renew')
+            except Exception:
+                logger.exception("Verifactu lease of company %s and NIF %s "
+                    "could not be renewed", self.company, self.nif)
+                continue
+            if not renewed:
+                self.lost = True
+                return
+
+    def check(self):
+        "Raise if the lease has been taken by another sender"
+        if self.lost:
+            raise UserError(gettext('aeat_verifactu.msg_verifactu_lease_lost',
+                    nif=self.nif))
+
+    def release(self):
+        self._stop_event.set()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
+        self._call('release')
+
+
+class VerifactuRun(ModelSQL, ModelView):
+    '''
+    AEAT Verifactu Run
+
+    Summary of a send_verifactu execution.
+    '''
+    __name__ = 'aeat.verifactu.run'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE')
+    state = fields.Selection([
+            ('running', "Running"),
+            ('done', "Done"),
+            ('failed', "Failed"),
+            ], 'State', readonly=True,
+        help="A run stays running if its process was interrupted.")
+    start = fields.Timestamp('Start', readonly=True)
+    end = fields.Timestamp('End', readonly=True)
+    duration = fields.TimeDelta('Duration', readonly=True)
+    invoices_considered = fields.Integer('Invoices Considered',
+        readonly=True)
+    invoices_sent = fields.Integer('Invoices Sent', readonly=True)
+    invoices_accepted = fields.Integer('Invoices Accepted', readonly=True)
+    invoices_rejected = fields.Integer('Invoices Rejected', readonly=True)
+    soap_calls = fields.Integer('SOAP Calls', readonly=True)
+    request_bytes = fields.Integer('Request Bytes', readonly=True)
+    response_bytes = fields.Integer('Response Bytes', readonly=True)
+    chain_number = fields.Char('Chain Anchor Number', readonly=True,
+        help="Number of the invoice used to chain the first record sent.")
+    chain_fingerprint = fields.Char('Chain Anchor Fingerprint',
+        readonly=True)
+    exception = fields.Text('Exception', readonly=True)
+    dispatch = fields.Char('Dispatch', readonly=True,
+        help="Identifies the runs started together for all the companies.")
+    metrics = fields.Dict(None, 'Metrics', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.company, Index.Equality()),
+                    (t.start, Index.Range(order='DESC'))),
+                Index(t, (t.dispatch, Index.Equality())),
+                Index(t, (t.state, Index.Equality(cardinality='low')),
+                    where=t.state.in_(['running', 'failed'])),
+                })
+        cls._order.insert(0, ('start', 'DESC'))
+
+    @staticmethod
+    def default_state():
+        return 'running'
+
+    @staticmethod
+    def _get_values(run_metrics):
+        counters = run_metrics.counters
+        sizes = run_metrics.sizes
+        return {
+            'end': run_metrics.end,
+            'duration': datetime.timedelta(seconds=run_metrics.duration),
+            'invoices_considered': counters.get('invoices_considered', 0),
+            'invoices_sent': counters.get('records_sent', 0),
+            'invoices_accepted': counters.get('records_accepted', 0),
+            'invoices_rejected': counters.get('records_rejected', 0),
+            'soap_calls': counters.get('soap_calls', 0),
+            'request_bytes': sizes.get('request_bytes', 0),
+            'response_bytes': sizes.get('response_bytes', 0),
+            'chain_number': run_metrics.values.get('chain_number'),
+            'chain_fingerprint': run_metrics.values.get('chain_fingerprint'),
+            'metrics': run_metrics.summary(),
+            }
+
+    # The runs are always written in a new transaction so they are kept even
+    # if the send failed and its transaction is rolled back
+
+    @classmethod
+    def open(cls, run_metrics):
+        "Store a running run and return its id"
+        with Transaction().new_transaction() as transaction:
+            run, = cls.create([{
+                        'company': run_metrics.company,
+                        'start': run_metrics.start,
+                        'dispatch': Transaction().context.get(
+                            'verifactu_dispatch'),
+                        }])
+            transaction.commit()
+        return run.id
+
+    @classmethod
+    def checkpoint(cls, run_id, run_metrics):
+        "Store the progress of the running run"
+        with Transaction().new_transaction() as transaction:
+            cls.write([cls(run_id)], cls._get_values(run_metrics))
+            transaction.commit()
+
+    @classmethod
+    def close(cls, run_id, run_metrics, exception=None):
+        values = cls._get_values(run_metrics)
+        values['state'] = 'failed' if exception else 'done'
+        values['exception'] = repr(exception) if exception else None
+        with Transaction().new_transaction() as transaction:
+            cls.write([cls(run_id)], values)
+            transaction.commit()
+
+    @classmethod
+    def log(cls, run_metrics, exception=None):
+        "Store a finished run and return its id"
+        run_id = cls.open(run_metrics)
+        cls.close(run_id, run_metrics, exception=exception)
+        return run_id
+
 
 class Invoice(metaclass=PoolMeta):
     __name__ = 'account.invoice'
@@ -158,15 +748,24 @@ class Invoice(metaclass=PoolMeta):
             'get_verifactu_fields', searcher='search_is_verifactu')
     verifactu_records = fields.One2Many('aeat.verifactu', 'invoice',
         "Verifactu Report Lines")
+    verifactu_last_record = fields.Many2One('aeat.verifactu',
+        "Verifactu Last Record", readonly=True)
+    verifactu_last_state = fields.Selection(AEAT_INVOICE_STATE,
+        "Verifactu Last State", readonly=True)
 
     @classmethod
     def __setup__(cls):
         super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.verifactu_last_state,
+                    Index.Equality(cardinality='low'))))
         verifactu_fields = {'verifactu_operation_key'}
         cls._check_modify_exclude |= verifactu_fields
         if hasattr(cls, '_intercompany_excluded_fields'):
             cls._intercompany_excluded_fields += verifactu_fields
-            cls._intercompany_excluded_fields += ['verifactu_records']
+            cls._intercompany_excluded_fields += ['verifactu_records',
+                'verifactu_last_record', 'verifactu_last_state']
 
         # not allow modify reference when is supplier or not pending to sending
         readonly = (
@@ -176,6 +775,56 @@ class Invoice(metaclass=PoolMeta):
         if 'readonly' in cls.reference.states:
             cls.reference.states['readonly'] |= readonly
 
+    @classmethod
+    def __register__(cls, module_name):
+        table_h = cls.__table_handler__(module_name)
+        fill_last_record = not table_h.column_exist('verifactu_last_record')
+
+        super().__register__(module_name)
+
+        if fill_last_record:
+            cls.update_verifactu_last_record()
+
+    @classmethod
+    def update_verifactu_last_record(cls, invoice_ids=None):
+        "Store the last aeat.verifactu record and its state on the invoices"
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        for query in cls._verifactu_last_record_queries(invoice_ids):
+            cursor.execute(*query)
+
+        # The columns are updated without the ORM so the cache is cleaned here
+        transaction.counter += 1
+        if invoice_ids is not None:
+            for cache in transaction.cache.values():
+                if cls.__name__ in cache:
+                    for invoice_id in invoice_ids:
+                        cache[cls.__name__].pop(invoice_id, None)
+
+    @classmethod
+    def _verifactu_last_record_queries(cls, invoice_ids=None):
+        pool = Pool()
+        Verifactu = pool.get('aeat.verifactu')
+        table = cls.__table__()
+        verifactu = Verifactu.__table__()
+        last_verifactu = Verifactu.__table__()
+
+        last_id = verifactu.select(Max(verifactu.id),
+            where=verifactu.invoice == table.id)
+        last_state = last_verifactu.select(last_verifactu.state,
+            where=last_verifactu.id == last_id)
+        if invoice_ids is None:
+            wheres = [table.id.in_(verifactu.select(verifactu.invoice))]
+        else:
+            wheres = [reduce_ids(table.id, sub_ids)
+                for sub_ids in grouped_slice(invoice_ids)]
+        for where in wheres:
+            yield table.update(
+                [table.verifactu_last_record, table.verifactu_last_state],
+                [last_id, last_state],
+                where=where)
+
     @classmethod
     def view_attributes(cls):
         return super().view_attributes() + [
@@ -189,27 +838,8 @@ class Invoice(metaclass=PoolMeta):
         pool = Pool()
         Period = pool.get('account.period')
         Date = pool.get('ir.date')
-        Verifactu = pool.get('aeat.verifactu')
-        cursor = Transaction().connection.cursor()
 
         result = {name: {} for name in names}
-        invoice_ids = [invoice.id for invoice in invoices if invoice.id]
-
-        latest_verifactu = {}
-        if invoice_ids and {'verifactu_state', 'verifactu_to_send'} & set(names):
-            verifactu = Verifactu.__table__()
-            query = verifactu.select(
-                verifactu.invoice,
-                Max(verifactu.id).as_('id'),
-                where=verifactu.invoice.in_(invoice_ids),
-                group_by=verifactu.invoice)
-            cursor.execute(*query)
-            latest_ids = dict(cursor.fetchall())
-            if latest_ids:
-                records = Verifactu.browse(list(latest_ids.values()))
-                by_id = {record.id: record for record in records}
-                for invoice_id, record_id in latest_ids.items():
-                    latest_verifactu[invoice_id] = by_id[record_id]
 
         period_cache = {}
         today = None
@@ -232,6 +862,9 @@ class Invoice(metaclass=PoolMeta):
                         accounting_date,
                         )
                     if key not in period_cache:
+                        period_cache[key] = period_send_invoices_cache.get(
+                            (key[0], accounting_date.isoformat()))
+                    if period_cache[key] is None:
                         period_cache[key] = False
                         if invoice.company:
                             with Transaction().set_context(
@@ -246,9 +879,12 @@ class Invoice(metaclass=PoolMeta):
                                 else:
                                     period_cache[key] = bool(
                                         period.es_verifactu_send_invoices)
+                        period_send_invoices_cache.set(
+                            (key[0], accounting_date.isoformat()),
+                            period_cache[key])
                     is_verifactu = period_cache[key]
 
-            record = latest_verifactu.get(invoice.id)
+            record = invoice.verifactu_last_record
 
             if 'is_verifactu' in result:
                 result['is_verifactu'][invoice.id] = is_verifactu
@@ -260,10 +896,8 @@ class Invoice(metaclass=PoolMeta):
                 if is_verifactu and invoice.number:
                     state = record.state if record else None
                     if state in {None, 'Incorrecto'}:
-                        error_message = (
-                            (record.error_message or '').lower()
-                            if record else '')
-                        to_send = 'duplicad' not in error_message
+                        to_send = aeat_errors.is_retryable(
+                            record.error_code if record else None)
                 result['verifactu_to_send'][invoice.id] = to_send
         return result
 
@@ -292,67 +926,48 @@ class Invoice(metaclass=PoolMeta):
 
     @classmethod
     def search_verifactu_to_send(cls, name, clause):
+        pool = Pool()
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
+        Verifactu = pool.get('aeat.verifactu')
+        invoice = cls.__table__()
+        move = Move.__table__()
+        period = Period.__table__()
+        journal = Journal.__table__()
+        verifactu = Verifactu.__table__()
+
         _, operator, value = clause
         if operator not in ('=', '!='):
             return []
+        # Same conditions as get_verifactu_fields for the posted invoices
+        query = (invoice
+            .join(move, condition=invoice.move == move.id)
+            .join(period, condition=move.period == period.id)
+            .join(journal, condition=invoice.journal == journal.id)
+            .join(verifactu, type_='LEFT',
+                condition=invoice.verifactu_last_record == verifactu.id)
+            .select(invoice.id,
+                where=(invoice.type == 'out')
+                & (invoice.number != Null)
+                & (period.es_verifactu_send_invoices == Literal(True))
+                & (Coalesce(journal.exclude_verifactu, Literal(False))
+                    == Literal(False))
+                & ((invoice.verifactu_last_state == Null)
+                    | (invoice.verifactu_last_state == 'Incorrecto'))
+                & ((verifactu.error_code == Null)
+                    | ~verifactu.error_code.in_(
+                        sorted(aeat_errors.PERMANENT_ERRORS)))))
         if (operator == '=' and not value) or (operator == '!=' and value):
-            domain = ['OR',
-                ('verifactu_state', 'in', ('Correcto', 'AceptadoConErrores')),
-                ('verifactu_state', '=', None),
-                ]
-        else:
-            domain = [('verifactu_state', '=', 'Incorrecto')]
-        return domain
+            return [('id', 'not in', query)]
+        return [('id', 'in', query)]
 
     def get_verifactu_state(self, name):
         return self.__class__.get_verifactu_fields([self], [name])[name][self.id]
 
     @classmethod
     def search_verifactu_state(cls, name, clause):
-        pool = Pool()
-        Verifactu = pool.get('aeat.verifactu')
-
-        verifactu = Verifactu.__table__()
-        _, operator, value = clause
-        invoice = cls.__table__()
-
-        # Assign a sorted value: 'Correcto' always wins
-        ordered_state = Case(
-            (verifactu.state == 'Correcto', '1-Correcto'),
-            (verifactu.state == 'AceptadoConErrores', '2-AceptadoConErrores'),
-            (verifactu.state == 'Incorrecto', '3-Incorrecto'),
-            else_=Null)
-
-        subquery = verifactu.select(verifactu.invoice,
-            Max(ordered_state).as_('best_raw'), group_by=verifactu.invoice)
-
-        # Extract only the state name (after the dash)
-        best_state = Substring(subquery.best_raw, 3)
-
-        # Si no hi ha cap registre → best_state és NULL → 'Incorrecto'
-        final_state = Coalesce(best_state, Literal('Incorrecto'))
-
-        # Construïm la condició segons l'operador
-        # Tryton normalitza els operadors, però gestionem els més habituals
-        if operator in ('=', '!='):
-            if value is None:
-                condition = (final_state == None) if operator == '=' else (final_state != None)
-            else:
-                condition = (final_state == value) if operator == '=' else (final_state != value)
-        elif operator in ('in', 'not in'):
-            if not value:
-                condition = Literal(False) if operator == 'in' else Literal(True)
-            else:
-                condition = final_state.in_(value)
-                if operator == 'not in':
-                    condition = ~condition
-        else:
-            condition = (final_state == value)
-
-        query = invoice.join(subquery, 'LEFT', subquery.invoice == invoice.id
-            ).select(invoice.id, where=condition)
-
-        return [('id', 'in', query)]
+        return [('verifactu_last_state',) + tuple(clause[1:])]
 
     def _credit(self, **values):
         credit = super()._credit(**values)
@@ -370,6 +985,8 @@ class Invoice(metaclass=PoolMeta):
         default = default.copy()
         default.setdefault('verifactu_operation_key')
         default.setdefault('verifactu_records')
+        default.setdefault('verifactu_last_record')
+        default.setdefault('verifactu_last_state')
         return super().copy(records, default=default)
 
     def _get_verifactu_operation_key(self):
@@ -382,13 +999,16 @@ class Invoice(metaclass=PoolMeta):
 
         super().process(invoices)
 
-        invoices_verifactu = ''
+        verifactu = cls.get_verifactu_fields(invoices,
+            ['is_verifactu', 'verifactu_state'])
+        invoices_verifactu = []
         for invoice in invoices:
-            if invoice.state != 'draft' or not invoice.is_verifactu:
+            if (invoice.state != 'draft'
+                    or not verifactu['is_verifactu'][invoice.id]):
                 continue
-            if invoice.verifactu_state:
-                invoices_verifactu += '\n%s: %s' % (
-                    invoice.number, invoice.verifactu_state)
+            state = verifactu['verifactu_state'][invoice.id]
+            if state:
+                invoices_verifactu.append('%s: %s' % (invoice.number, state))
         if invoices_verifactu:
             warning_name = 'invoices_verifactu.' + hashlib.md5(
                 ''.join(invoices_verifactu).encode('utf-8')).hexdigest()
@@ -402,13 +1022,15 @@ class Invoice(metaclass=PoolMeta):
         pool = Pool()
         Warning = pool.get('res.user.warning')
 
+        verifactu = cls.get_verifactu_fields(invoices,
+            ['is_verifactu', 'verifactu_state'])
         invoices_verifactu = []
         for invoice in invoices:
-            if not invoice.is_verifactu:
+            if not verifactu['is_verifactu'][invoice.id]:
                 continue
-            if invoice.verifactu_state:
-                invoices_verifactu.append('%s: %s' % (
-                    invoice.number, invoice.verifactu_state))
+            state = verifactu['verifactu_state'][invoice.id]
+            if state:
+                invoices_verifactu.append('%s: %s' % (invoice.number, state))
         if invoices_verifactu:
             warning_name = 'invoices_verifactu.' + hashlib.md5(
                 ''.join(invoices_verifactu).encode('utf-8')).hexdigest()
@@ -441,21 +1063,20 @@ class Invoice(metaclass=PoolMeta):
 
     @classmethod
     def _post(cls, invoices):
-        to_check = []
-        for invoice in invoices:
-            if not invoice.is_verifactu:
-                continue
+        # Computed once for all the invoices as it may search their periods
+        is_verifactu = cls.get_verifactu_fields(invoices,
+            ['is_verifactu'])['is_verifactu']
+        invoices_verifactu = [i for i in invoices if is_verifactu[i.id]]
 
+        to_check = []
+        for invoice in invoices_verifactu:
             invoice.verifactu_state = 'PendienteEnvio'
             if not invoice.move or invoice.move.state == 'draft':
                 to_check.append(invoice)
 
-        # Set verifactu_operation_key for all cases in which we can
-        # know it automatically which basically only does not include
-        # credit notes for non-simplified invoices
-        for invoice in invoices:
-            if not invoice.is_verifactu:
-                continue
+            # Set verifactu_operation_key for all cases in which we can
+            # know it automatically which basically only does not include
+            # credit notes for non-simplified invoices
             if invoice.simplified:
                 first_invoice = invoice.simplified_serial_number('first')
                 last_invoice = invoice.simplified_serial_number('last')
@@ -470,10 +1091,6 @@ class Invoice(metaclass=PoolMeta):
                 if invoice.total_amount >= 0:
                     invoice.verifactu_operation_key = 'F1'
 
-            if not invoice.move or invoice.move.state == 'draft':
-                to_check.append(invoice)
-
-
         for invoice in to_check:
             for tax in invoice.taxes:
                 if (tax.tax.verifactu_subjected_key in ('S2', 'S3')
@@ -494,53 +1111,230 @@ class Invoice(metaclass=PoolMeta):
                     invoice.verifactu_state = 'PendienteEnvioSubsanacion'
 
         super()._post(invoices)
+        cls.verifactu_enqueue_send(invoices_verifactu)
+
+    @classmethod
+    def verifactu_enqueue_send(cls, invoices):
+        '''
+        Queue a send of the issuers of the posted Verifactu invoices after a
+        debounce delay unless one is already waiting, so the invoices posted
+        during the delay are sent together
+
+        The send is not scheduled before the wait time requested by AEAT for
+        the issuer. The cron still sends the invoices left behind.
+        '''
+        pool = Pool()
+        Queue = pool.get('ir.queue')
+        Chain = pool.get('aeat.verifactu.chain')
+
+        # Without workers the send would run at the end of the posting
+        if (not config.getboolean('queue', 'worker', default=False)
+                or not config.getboolean('aeat_verifactu', 'send_on_post',
+                    default=True)):
+            return
+        to_send = defaultdict(list)
+        for invoice in invoices:
+            to_send[invoice.company.id].append(invoice.id)
+        if not to_send:
+            return
+
+        with without_check_access():
+            tasks = Queue.search([
+                    ('name', '=', VERIFACTU_QUEUE),
+                    ('dequeued_at', '=', None),
+                    ])
+            for task in tasks:
+                data = task.data or {}
+                if (data.get('model') == cls.__name__
+                        and data.get('method') == 'send_verifactu'):
+                    to_send.pop(
+                        (data.get('context') or {}).get('company'), None)
+            heads = Chain.search([
+                    ('company', 'in', list(to_send.keys())),
+                    ('next_send', '!=', None),
+                    ])
+
+        now = datetime.datetime.now()
+        delay = datetime.timedelta(seconds=config.getfloat(
+                'aeat_verifactu', 'send_delay', default=5))
+        delays = defaultdict(lambda: delay)
+        for head in heads:
+            company = head.company.id
+            # Otherwise send_verifactu would defer the records until the
+            # next cron
+            delays[company] = max(delays[company], head.next_send - now)
+        for company, invoice_ids in to_send.items():
+            with Transaction().set_context(company=company,
+                    queue_name=VERIFACTU_QUEUE,
+                    queue_scheduled_at=delays[company]):
+                cls.__queue__.send_verifactu(cls.browse(invoice_ids))
 
     @staticmethod
     def verifactu_service(crt, pkey):
-        if PRODUCTION_ENV:
-            wsdl = WSDL_PROD
-            port_name = 'SistemaVerifactu'
-        else:
-            wsdl = WSDL_TEST
-            port_name = 'SistemaVerifactuPruebas'
-
-        wsdl += 'SistemaFacturacion.wsdl'
-        session = Session()
-        session.cert = (crt, pkey)
-        transport = Transport(session=session)
-        settings = Settings(forbid_entities=False)
-        plugins = [HistoryPlugin()]
+        wsdl, port_name = get_wsdl()
+        # The client is reused between runs while the certificate does not
+        # change to keep its connections, the WSDL is parsed only once for
+        # all the clients
+        digest = hashlib.sha256()
+        for path in (crt, pkey):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        key = (wsdl, port_name, digest.hexdigest())
+        with _clients_lock:
+            client = _clients.get(key)
+        if client is None:
+            session = tools.CertificateSession()
+            transport = Transport(session=session, cache=get_wsdl_cache())
+            plugins = [HistoryPlugin(), metrics.MetricsPlugin()]
+            if not PRODUCTION_ENV:
+                plugins.append(tools.LoggingPlugin())
+            client = Client(wsdl=get_wsdl_document(), transport=transport,
+                plugins=plugins, settings=Settings(forbid_entities=False))
+            with _clients_lock:
+                _clients[key] = client
+        # The credentials are temporary files that only live during the run
+        # so they are set only for the current context
+        client.transport.session.cert = (crt, pkey)
+        return client.bind('sfVerifactu', port_name)
+
+    @staticmethod
+    def verifactu_async_client(ssl_context):
+        '''
+        Return a zeep asyncio client authenticated with ssl_context
+
+        The client is created from the WSDL already parsed so it does not
+        block the event loop, but its transport must be closed inside the
+        event loop that used it.
+        '''
+        if httpx is None:
+            raise UserError(gettext('aeat_verifactu.msg_missing_httpx'))
+        transport = SubmitAsyncTransport(
+            httpx.AsyncClient(verify=ssl_context, timeout=300))
+        plugins = [HistoryPlugin(), metrics.MetricsPlugin()]
         if not PRODUCTION_ENV:
             plugins.append(tools.LoggingPlugin())
-        for retry in range(3):
-            try:
-                client = Client(wsdl=wsdl, transport=transport, plugins=plugins, settings=settings)
-                break
-            except Exception as e:
-                if retry < 2:
-                    time.sleep(2 ** retry)
-                    continue
-                raise UserError(str(e))
-        return client.bind('sfVerifactu', port_name)
+        return AsyncClient(wsdl=get_wsdl_document(), transport=transport,
+            plugins=plugins, settings=Settings(forbid_entities=False))
 
     @classmethod
-    def build_verifactu_records(cls, invoices, last_line=None):
+    def verifactu_prefetch(cls, invoices):
+        '''
+        Read in bulk the data used by verifactu_build_invoice for all the
+        invoices and return it by invoice id
+        '''
+        pool = Pool()
+        InvoiceTax = pool.get('account.invoice.tax')
+        Tax = pool.get('account.tax')
+        Identifier = pool.get('party.identifier')
+
+        invoice_tax_ids = [t.id for i in invoices for t in i.taxes]
+        invoice_taxes = InvoiceTax.read(invoice_tax_ids, [
+                'invoice', 'tax', 'base', 'company_base', 'company_amount'])
+
+        # Related and parent taxes are only compared by identity so a single
+        # namespace is shared by all the references to a tax
+        taxes = {}
+        for values in Tax.read(
+                list({v['tax'] for v in invoice_taxes if v['tax']}), [
+                    'tax_kind', 'rate', 'verifactu_issued_key',
+                    'verifactu_subjected_key', 'verifactu_exemption_cause',
+                    'recargo_equivalencia_related_tax', 'parent']):
+            tax = taxes.setdefault(values['id'], SimpleNamespace())
+            related_id = values.pop('recargo_equivalencia_related_tax')
+            parent_id = values.pop('parent')
+            vars(tax).update(values,
+                recargo_equivalencia_related_tax=(
+                    taxes.setdefault(related_id, SimpleNamespace(
+                            id=related_id)) if related_id else None),
+                parent=(taxes.setdefault(parent_id, SimpleNamespace(
+                            id=parent_id)) if parent_id else None))
+
+        result = {}
+        nifs = {}
+        for invoice in invoices:
+            company = invoice.company
+            if company.id not in nifs:
+                nifs[company.id] = company.party.verifactu_vat_code
+            result[invoice.id] = SimpleNamespace(
+                nif=nifs[company.id],
+                taxes=[],
+                identifier=None)
+        for values in invoice_taxes:
+            result[values['invoice']].taxes.append(SimpleNamespace(
+                    id=values['id'],
+                    base=values['base'],
+                    company_base=values['company_base'],
+                    company_amount=values['company_amount'],
+                    tax=taxes.get(values['tax'])))
+
+        # The counterpart identifiers only need their code and type
+        identifiers = {
+            values['id']: Identifier(**values)
+            for values in Identifier.read(
+                list({i.party_tax_identifier.id
+                        for i in invoices if i.party_tax_identifier}),
+                ['code', 'type'])}
+        for invoice in invoices:
+            if invoice.party_tax_identifier:
+                result[invoice.id].identifier = identifiers[
+                    invoice.party_tax_identifier.id]
+        return result
+
+    @classmethod
+    def build_verifactu_records(cls, invoices, last_line=None,
+            prefetched=None):
         body = []
         for invoice in invoices:
-            record = invoice.verifactu_build_invoice(
-                last_line=last_line)
+            if prefetched is not None:
+                record = invoice.verifactu_build_invoice(
+                    last_line=last_line,
+                    prefetched=prefetched.get(invoice.id))
+            else:
+                record = invoice.verifactu_build_invoice(
+                    last_line=last_line)
             body.append({'RegistroAlta': record})
             last_line = SimpleNamespace(
                 invoice=invoice, fingerprint=record['Huella'])
         return body
 
+    @staticmethod
+    def verifactu_batch_size():
+        size = config.getint('aeat_verifactu', 'batch_size',
+            default=MAX_RECORDS)
+        return max(1, min(size, MAX_RECORDS))
+
+    @staticmethod
+    def verifactu_can_send(count, next_send):
+        '''
+        Return if count records can be submitted now
+
+        AEAT allows to send MAX_RECORDS records before the wait time it
+        returned for the previous submission.
+        '''
+        return (count >= MAX_RECORDS or not next_send
+            or datetime.datetime.now() >= next_send)
+
+    @classmethod
+    def verifactu_submit_batch(cls, service, headers, batch):
+        return service.RegFactuSistemaFacturacion(headers, batch)
+
     @classmethod
     def verifactu_submit_records(cls, service, headers, records):
-        responses = []
-        for batch in grouped_slice(records, 1):
+        '''
+        Return the responses by IDFactura and the TiempoEsperaEnvio in
+        seconds of the last submission
+        '''
+        # AEAT does not guarantee the order of the RespuestaLinea elements
+        # and may omit some of them, so responses are keyed by IDFactura
+        responses = {}
+        wait = None
+        for batch in grouped_slice(records, cls.verifactu_batch_size()):
             batch = list(batch)
-            responses += service.RegFactuSistemaFacturacion(headers, batch).RespuestaLinea
-        return responses
+            response = cls.verifactu_submit_batch(service, headers, batch)
+            for line in response.RespuestaLinea or []:
+                responses[tools.record_key(line['IDFactura'])] = line
+            wait = getattr(response, 'TiempoEsperaEnvio', None)
+        return responses, wait
 
     @classmethod
     def verifactu_query(cls, service, year=None, period=None,
@@ -562,7 +1356,24 @@ class Invoice(metaclass=PoolMeta):
         return service.ConsultaFactuSistemaFacturacion(headers, filter_)
 
     @classmethod
-    def get_batch_start_verifactu_info(cls, service, company):
+    def get_batch_start_verifactu_info(cls, service, company, resync=False):
+        pool = Pool()
+        Chain = pool.get('aeat.verifactu.chain')
+
+        nif = company.party.verifactu_vat_code
+        if not resync:
+            head = Chain.get_head(company, nif)
+            if head and head.fingerprint:
+                return head.get_last_line()
+        last_line = cls.get_remote_batch_start_verifactu_info(
+            service, company)
+        if last_line:
+            Chain.set_head(company, nif, last_line.invoice.number,
+                last_line.invoice.invoice_date, last_line.fingerprint)
+        return last_line
+
+    @classmethod
+    def get_remote_batch_start_verifactu_info(cls, service, company):
         pool = Pool()
         Date = pool.get('ir.date')
 
@@ -610,9 +1421,10 @@ class Invoice(metaclass=PoolMeta):
         # 'invoices' parameter is not used, because all pending invoices are
         # sent but we need it to be compatible with the queue system
         pool = Pool()
-        Verifactu = pool.get('aeat.verifactu')
         VerifactuConfig = pool.get('account.configuration.default_verifactu')
         Company = pool.get('company.company')
+        Lease = pool.get('aeat.verifactu.lease')
+        Run = pool.get('aeat.verifactu.run')
 
         company = Company(Transaction().context.get('company'))
         configs = VerifactuConfig.search([
@@ -620,50 +1432,616 @@ class Invoice(metaclass=PoolMeta):
                 ], limit=1)
         if not configs:
             return
-        VerifactuConfig.lock(configs)
 
         config, = configs
         if not config.aeat_certificate_verifactu:
             return
 
-        invoices = cls.search([
+        nif = company.party.verifactu_vat_code
+        lease = Lease.hold(company, nif)
+        if not lease:
+            logger.info("Verifactu send of company %s skipped, NIF %s is "
+                "being sent by another process", company.id, nif)
+            return
+        try:
+            with metrics.collect(company.id) as run_metrics:
+                run_id = Run.open(run_metrics)
+                try:
+                    cls._send_verifactu(company, run_id=run_id, lease=lease)
+                except Exception as exception:
+                    run_metrics.stop()
+                    Run.close(run_id, run_metrics, exception=exception)
+                    raise
+                else:
+                    run_metrics.stop()
+                    Run.close(run_id, run_metrics)
+                    return run_id
+        finally:
+            lease.release()
+
+    @classmethod
+    def verifactu_companies(cls):
+        '''
+        Return the ids of the companies with a Verifactu certificate
+
+        All the companies are returned whatever the record rules of the user.
+        '''
+        pool = Pool()
+        VerifactuConfig = pool.get('account.configuration.default_verifactu')
+
+        with without_check_access():
+            configs = VerifactuConfig.search([
+                    ('aeat_certificate_verifactu', '!=', None),
+                    ])
+            return sorted({c.company.id for c in configs if c.company})
+
+    @classmethod
+    def send_verifactu_companies(cls, companies=None):
+        '''
+        Send the pending invoices of all the companies, each one in its own
+        thread and transaction so a slow issuer does not delay the others
+        '''
+        pool = Pool()
+        Run = pool.get('aeat.verifactu.run')
+
+        transaction = Transaction()
+        database = transaction.database.name
+        user = transaction.user
+        if companies is None:
+            companies = cls.verifactu_companies()
+        else:
+            companies = list(map(int, companies))
+        if not companies:
+            return
+        dispatch = uuid.uuid4().hex
+        context = dict(transaction.context, verifactu_dispatch=dispatch)
+        workers = config.getint('aeat_verifactu', 'dispatch_workers',
+            default=4)
+
+        def send(company):
+            with Transaction().start(database, user,
+                    context=dict(context, company=company)):
+                Invoice = Pool().get('account.invoice')
+                Invoice.send_verifactu()
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=max(1, workers),
+                thread_name_prefix='verifactu') as executor:
+            futures = {executor.submit(send, c): c for c in companies}
+            for future, company in futures.items():
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception(
+                        "Verifactu send failed for company %s", company)
+                    failed.append(company)
+
+        # The runs are committed by their own transactions
+        with Transaction().new_transaction(readonly=True):
+            runs = Run.search([('dispatch', '=', dispatch)])
+            logger.info("Verifactu dispatch %s: %s companies, "
+                "%s failed, %s invoices sent, %s rejected", dispatch,
+                len(companies), len(failed),
+                sum(r.invoices_sent or 0 for r in runs),
+                sum(r.invoices_rejected or 0 for r in runs))
+        return dispatch
+
+    @classmethod
+    def send_verifactu_companies_async(cls, companies=None):
+        '''
+        Send the pending invoices of all the companies from a single thread
+        keeping the submissions of all the issuers in flight at once
+
+        The sending goes by rounds: the next batch of each issuer is built in
+        a transaction, the batches of all the issuers are submitted at once
+        and the responses of each issuer are saved in a transaction. So a
+        single batch by issuer is kept in memory and the event loop only
+        waits for AEAT. The lease of each issuer is held in between.
+        '''
+        pool = Pool()
+        Run = pool.get('aeat.verifactu.run')
+
+        transaction = Transaction()
+        database = transaction.database.name
+        user = transaction.user
+        if companies is None:
+            companies = cls.verifactu_companies()
+        else:
+            companies = list(map(int, companies))
+        if not companies:
+            return
+        dispatch = uuid.uuid4().hex
+        context = dict(transaction.context, verifactu_dispatch=dispatch)
+
+        def step(sender, method):
+            "Call method for sender in its own transaction"
+            try:
+                with metrics.activate(sender.metrics), \
+                        Transaction(new=True).start(database, user,
+                            context=dict(context, company=sender.company)):
+                    Invoice = Pool().get('account.invoice')
+                    return getattr(Invoice, method)(sender)
+            except Exception as exception:
+                logger.exception(
+                    "Verifactu send failed for company %s", sender.company)
+                sender.error = exception
+
+        async def submit(senders):
+            semaphore = asyncio.Semaphore(max(1, config.getint(
+                        'aeat_verifactu', 'async_concurrency', default=16)))
+
+            async def submit_sender(sender):
+                async with semaphore:
+                    with metrics.activate(sender.metrics):
+                        try:
+                            await cls.verifactu_submit_batch_async(
+                                sender.service, sender.headers, sender.batch)
+                        except Exception as exception:
+                            logger.exception("Verifactu submission failed "
+                                "for company %s", sender.company)
+                            sender.error = exception
+
+            await asyncio.gather(*(submit_sender(s) for s in senders))
+
+        senders = []
+        for company in companies:
+            sender = SimpleNamespace(company=company,
+                metrics=metrics.Metrics(company), lease=None, client=None,
+                batch=None, error=None)
+            senders.append(sender)
+            step(sender, 'verifactu_async_open')
+
+        # The clients are bound to the event loop so a single one is used
+        # for all the rounds
+        loop = asyncio.new_event_loop()
+        try:
+            active = [s for s in senders if s.lease and not s.error]
+            while active:
+                for sender in active:
+                    sender.batch = step(sender, 'verifactu_async_build')
+                active = [s for s in active if s.batch]
+                if not active:
+                    break
+                loop.run_until_complete(submit(active))
+                active = [s for s in active if not s.error]
+                for sender in active:
+                    step(sender, 'verifactu_async_save')
+                active = [s for s in active if not s.error]
+        finally:
+            for sender in senders:
+                if sender.client:
+                    loop.run_until_complete(sender.client.transport.aclose())
+                if sender.lease:
+                    try:
+                        sender.lease.release()
+                    except Exception:
+                        logger.exception("Verifactu lease of company %s "
+                            "could not be released", sender.company)
+                if sender.lease or sender.error:
+                    step(sender, 'verifactu_async_close')
+                metrics.finish(sender.metrics)
+            loop.close()
+
+        with Transaction().new_transaction(readonly=True):
+            runs = Run.search([('dispatch', '=', dispatch)])
+            logger.info("Verifactu dispatch %s: %s companies, "
+                "%s invoices sent, %s rejected", dispatch, len(companies),
+                sum(r.invoices_sent or 0 for r in runs),
+                sum(r.invoices_rejected or 0 for r in runs))
+        return dispatch
+
+    @classmethod
+    def verifactu_async_open(cls, sender):
+        '''
+        Hold the lease of the issuer of the sender and prepare its asyncio
+        client if there are invoices that can be sent now
+
+        The lease is left to None if there is nothing to send, in which case
+        the run is logged, or the issuer is being sent by another process.
+        '''
+        pool = Pool()
+        VerifactuConfig = pool.get('account.configuration.default_verifactu')
+        Company = pool.get('company.company')
+        Chain = pool.get('aeat.verifactu.chain')
+        Lease = pool.get('aeat.verifactu.lease')
+
+        company = Company(sender.company)
+        configs = VerifactuConfig.search([
                 ('company', '=', company),
-                ('move.period.es_verifactu_send_invoices', '=', True),
-                ('journal.exclude_verifactu', '!=', True),
-                ('type', '=', 'out'),
-                ('verifactu_to_send', '=', True),
-                ], order=[('sequence', 'ASC'), ('number_digit', 'ASC'),
-                    ('invoice_date', 'ASC'), ('id', 'ASC')])
-        if not invoices:
+                ], limit=1)
+        if not configs or not configs[0].aeat_certificate_verifactu:
+            return
+        nif = company.party.verifactu_vat_code
+        lease = Lease.hold(company, nif)
+        if not lease:
+            logger.info("Verifactu send of company %s skipped, NIF %s is "
+                "being sent by another process", company.id, nif)
             return
+        try:
+            invoice_ids = cls.verifactu_pending_ids(company)
+            batch_size = cls.verifactu_batch_size()
+            head = Chain.get_head(company, nif)
+            next_send = head.next_send if head else None
+            if (invoice_ids
+                    and not cls.verifactu_can_send(
+                        min(len(invoice_ids), batch_size), next_send)):
+                metrics.incr('records_deferred', len(invoice_ids))
+                invoice_ids = []
+            if not invoice_ids:
+                # The run is logged like when send_verifactu has nothing to
+                # send
+                lease.release()
+                cls.verifactu_async_close(sender)
+                return
+
+            certificate = cls._get_verifactu_certificate()
+            with certificate.tmp_ssl_credentials() as (crt, key):
+                ssl_context = ssl.create_default_context()
+                ssl_context.load_cert_chain(crt, key)
+                with metrics.timer('service'):
+                    service = cls.verifactu_service(crt, key)
+                with metrics.timer('chain'):
+                    last_line = cls.verifactu_chain_start(service, company)
+            if last_line:
+                metrics.set_value('chain_number', last_line.invoice.number)
+                metrics.set_value('chain_fingerprint', last_line.fingerprint)
+            with metrics.timer('service'):
+                client = cls.verifactu_async_client(ssl_context)
+        except Exception:
+            lease.release()
+            raise
+        _, port_name = get_wsdl()
+        vars(sender).update(
+            lease=lease,
+            client=client,
+            service=client.bind('sfVerifactu', port_name),
+            nif=nif,
+            headers=get_headers(company),
+            chunks=(list(c) for c in grouped_slice(invoice_ids, batch_size)),
+            pending=len(invoice_ids),
+            next_send=next_send)
+
+    @classmethod
+    def verifactu_async_build(cls, sender):
+        "Return the next batch of the sender or None if it is finished"
+        pool = Pool()
+        Company = pool.get('company.company')
+        Chain = pool.get('aeat.verifactu.chain')
+
+        # Stop before the next batch if another sender took over
+        sender.lease.check()
+        sub_ids = next(sender.chunks, None)
+        if sub_ids is None:
+            return
+        if not cls.verifactu_can_send(len(sub_ids), sender.next_send):
+            metrics.incr('records_deferred', sender.pending)
+            return
+        # The head is committed with the previous batch
+        head = Chain.get_head(Company(sender.company), sender.nif)
+        last_line = (head.get_last_line()
+            if head and head.fingerprint else None)
+        invoices, records = cls._build_verifactu_batch(sub_ids, last_line)
+        metrics.incr('records_sent', len(records))
+        metrics.incr('records_retried', len(
+                [i for i in invoices if i.verifactu_last_state]))
+        sender.pending -= len(sub_ids)
+        return SimpleNamespace(
+            invoice_ids=sub_ids,
+            records=records,
+            responses=None,
+            next_send=None)
+
+    @classmethod
+    async def verifactu_submit_batch_async(cls, service, headers, batch):
+        with metrics.timer('submit'):
+            response = await service.RegFactuSistemaFacturacion(
+                headers, batch.records)
+        batch.responses = {
+            tools.record_key(line['IDFactura']): line
+            for line in response.RespuestaLinea or []}
+        wait = getattr(response, 'TiempoEsperaEnvio', None)
+        if wait is not None:
+            batch.next_send = (datetime.datetime.now()
+                + datetime.timedelta(seconds=int(wait)))
+
+    @classmethod
+    def verifactu_async_save(cls, sender):
+        "Save the responses of the batch submitted by the sender"
+        batch = sender.batch
+        cls.verifactu_save_batch(sender.company, batch.invoice_ids,
+            batch.records, batch.responses, next_send=batch.next_send)
+        if batch.next_send:
+            sender.next_send = batch.next_send
+        sender.batch = None
+
+    @classmethod
+    def verifactu_async_close(cls, sender):
+        "Log the run of the sender"
+        pool = Pool()
+        Run = pool.get('aeat.verifactu.run')
+
+        sender.metrics.stop()
+        return Run.log(sender.metrics, exception=sender.error)
+
+    @classmethod
+    def verifactu_pending_ids(cls, company):
+        "Return the ids of the invoices to send of company in chain order"
+        with metrics.timer('search'):
+            invoice_ids = list(map(int, cls.search([
+                            ('company', '=', company),
+                            ('verifactu_to_send', '=', True),
+                            ], order=[('sequence', 'ASC'),
+                            ('number_digit', 'ASC'),
+                            ('invoice_date', 'ASC'), ('id', 'ASC')])))
+        metrics.incr('invoices_considered', len(invoice_ids))
+        return invoice_ids
+
+    @classmethod
+    def _send_verifactu(cls, company, run_id=None, lease=None):
+        pool = Pool()
+        Chain = pool.get('aeat.verifactu.chain')
+        Run = pool.get('aeat.verifactu.run')
+
+        # Only the ids are kept for the whole backlog, the invoices are
+        # browsed, built, sent and saved chunk by chunk
+        invoice_ids = cls.verifactu_pending_ids(company)
+        if not invoice_ids:
+            return
+
+        batch_size = cls.verifactu_batch_size()
+        nif = company.party.verifactu_vat_code
+        head = Chain.get_head(company, nif)
+        next_send = head.next_send if head else None
+        # Defer the run while AEAT would throttle it so the records keep
+        # accumulating to fill the batches of the next runs
+        if not cls.verifactu_can_send(
+                min(len(invoice_ids), batch_size), next_send):
+            metrics.incr('records_deferred', len(invoice_ids))
+            return
+
         certificate = cls._get_verifactu_certificate()
         with certificate.tmp_ssl_credentials() as (crt, key):
-            service = cls.verifactu_service(crt, key)
-            last_line = cls.get_batch_start_verifactu_info(service, company)
+            with metrics.timer('service'):
+                service = cls.verifactu_service(crt, key)
+            headers = get_headers(company)
+            with metrics.timer('chain'):
+                last_line = cls.verifactu_chain_start(service, company)
+            if last_line:
+                metrics.set_value('chain_number', last_line.invoice.number)
+                metrics.set_value('chain_fingerprint', last_line.fingerprint)
+            chunks = [list(c) for c in grouped_slice(invoice_ids, batch_size)]
+            # While a batch is in flight, the next one is built chained to
+            # its last record
+            pipeline = (len(chunks) > 1
+                and config.getboolean('aeat_verifactu', 'pipeline',
+                    default=False))
+            executor = (ThreadPoolExecutor(max_workers=1,
+                    thread_name_prefix='verifactu-submit')
+                if pipeline else None)
+            try:
+                prebuilt = None
+                for i, sub_ids in enumerate(chunks):
+                    if not cls.verifactu_can_send(len(sub_ids), next_send):
+                        metrics.incr('records_deferred',
+                            len(invoice_ids) - i * batch_size)
+                        break
+                    if (prebuilt and prebuilt.last_line.fingerprint
+                            == getattr(last_line, 'fingerprint', None)):
+                        invoices, records = prebuilt.invoices, prebuilt.records
+                    else:
+                        if prebuilt:
+                            # The predicted head was not accepted
+                            metrics.incr('batches_rebuilt')
+                        invoices, records = cls._build_verifactu_batch(
+                            sub_ids, last_line)
+                    prebuilt = None
+                    metrics.incr('records_sent', len(records))
+                    metrics.incr('records_retried', len(
+                            [i for i in invoices if i.verifactu_last_state]))
+                    if executor:
+                        future = executor.submit(
+                            contextvars.copy_context().run,
+                            cls.verifactu_submit_records, service, headers,
+                            records)
+                        if i + 1 < len(chunks):
+                            predicted = SimpleNamespace(
+                                invoice=invoices[-1],
+                                fingerprint=(
+                                    records[-1]['RegistroAlta']['Huella']))
+                            prebuilt = SimpleNamespace(last_line=predicted)
+                            prebuilt.invoices, prebuilt.records = (
+                                cls._build_verifactu_batch(
+                                    chunks[i + 1], predicted))
+                        with metrics.timer('submit'):
+                            responses, wait = future.result()
+                    else:
+                        with metrics.timer('submit'):
+                            responses, wait = cls.verifactu_submit_records(
+                                service, headers, records)
+                    wait_until = None
+                    if wait is not None:
+                        next_send = wait_until = (datetime.datetime.now()
+                            + datetime.timedelta(seconds=int(wait)))
+                    # Each batch is saved and committed with the chain head
+                    # by its own transaction so an interrupted run resumes
+                    # after it without querying AEAT
+                    with Transaction().new_transaction() as transaction:
+                        cls.verifactu_save_batch(company.id,
+                            [i.id for i in invoices], records, responses,
+                            next_send=wait_until)
+                        transaction.commit()
+                    last_line = cls.verifactu_chain_head(
+                        last_line, invoices, records, responses)
+                    if run_id is not None:
+                        Run.checkpoint(run_id, metrics.current())
+                    if lease:
+                        # Stop before the next batch if another sender took
+                        # over
+                        lease.check()
+            finally:
+                if executor:
+                    executor.shutdown()
+
+    @classmethod
+    def verifactu_chain_start(cls, service, company):
+        "Return the line to chain the first record sent of company"
+        # The remote head adopted is committed by its own transaction like
+        # the batches
+        with Transaction().new_transaction() as transaction:
+            last_line = cls.get_batch_start_verifactu_info(service,
+                company, resync=Transaction().context.get(
+                    'verifactu_resync', False))
+            transaction.commit()
+        return last_line
+
+    @classmethod
+    def verifactu_save_batch(cls, company, invoice_ids, records, responses,
+            next_send=None):
+        "Save the responses of a submitted batch and the next send time"
+        pool = Pool()
+        Company = pool.get('company.company')
+        Chain = pool.get('aeat.verifactu.chain')
+
+        company = Company(company)
+        if next_send:
+            Chain.set_next_send(
+                company, company.party.verifactu_vat_code, next_send)
+        with metrics.timer('save'):
+            return cls.save_verifactu_responses(
+                company, cls.browse(invoice_ids), records, responses)
+
+    @classmethod
+    def _build_verifactu_batch(cls, invoice_ids, last_line):
+        invoices = cls.browse(invoice_ids)
+        with metrics.timer('prefetch'):
+            prefetched = cls.verifactu_prefetch(invoices)
+        with metrics.timer('build'):
             records = cls.build_verifactu_records(
-                invoices, last_line=last_line)
-            responses = cls.verifactu_submit_records(
-                service, get_headers(company), records)
-            lines_to_save = []
-            for invoice, record, response in zip(invoices, records, responses):
-                state = response['EstadoRegistro']
-                new_line = Verifactu()
-                new_line.invoice = invoice
-                new_line.company = company
-                new_line.state = state
-                new_line.fingerprint = record['RegistroAlta']['Huella']
-                new_line.error_message = (
-                    response['DescripcionErrorRegistro']
-                    if 'DescripcionErrorRegistro' in response
-                    else None)
-                lines_to_save.append(new_line)
-            Verifactu.save(lines_to_save)
-
-    def verifactu_build_invoice(self, last_line=None):
-
-        def verifactu_taxes():
-            return [invoice_tax for invoice_tax in self.taxes if
-                not invoice_tax.tax.tax_kind == 'surcharge']
+                invoices, last_line=last_line, prefetched=prefetched)
+        return invoices, records
+
+    @staticmethod
+    def verifactu_chain_head(last_line, invoices, records, responses):
+        '''
+        Return the line of the last record accepted by AEAT to chain the next
+        records or last_line if none was accepted
+        '''
+        for invoice, record in zip(reversed(invoices), reversed(records)):
+            response = responses.get(
+                tools.record_key(record['RegistroAlta']['IDFactura']))
+            if response and response['EstadoRegistro'] in {
+                    'Correcto', 'AceptadoConErrores'}:
+                return SimpleNamespace(
+                    invoice=invoice,
+                    fingerprint=record['RegistroAlta']['Huella'])
+        return last_line
+
+    @classmethod
+    def save_verifactu_responses(cls, company, invoices, records, responses):
+        pool = Pool()
+        Verifactu = pool.get('aeat.verifactu')
+
+        lines_to_save = []
+        for invoice, record in zip(invoices, records):
+            response = responses.get(
+                tools.record_key(record['RegistroAlta']['IDFactura']))
+            if response is None:
+                # Not processed by AEAT, it will be sent again
+                continue
+            state = response['EstadoRegistro']
+            new_line = Verifactu()
+            new_line.invoice = invoice
+            new_line.company = company
+            new_line.state = state
+            new_line.fingerprint = record['RegistroAlta']['Huella']
+            new_line.error_message = (
+                response['DescripcionErrorRegistro']
+                if 'DescripcionErrorRegistro' in response
+                else None)
+            error_code = (response['CodigoErrorRegistro']
+                if 'CodigoErrorRegistro' in response else None)
+            new_line.error_code = (
+                str(error_code) if error_code is not None else None)
+            lines_to_save.append(new_line)
+            if state == 'Incorrecto':
+                metrics.incr('records_rejected')
+            else:
+                metrics.incr('records_accepted')
+        Verifactu.save(lines_to_save)
+        return lines_to_save
+
+    @staticmethod
+    def verifactu_tax_breakdown(taxes):
+        '''
+        Return the non surcharge taxes with their equivalence surcharge tax
+        and the CuotaTotal and ImporteTotal amounts
+        '''
+        # Surcharges by related tax and sign of the base, a zero base
+        # matches both signs
+        surcharges = {}
+        for tax in taxes:
+            if tax.tax.tax_kind == 'surcharge':
+                signs = [tax.base.is_signed()] if tax.base else [False, True]
+                for signed in signs:
+                    surcharges.setdefault((tax.tax.id, signed), tax)
+
+        lines = []
+        taxes_base = 0
+        taxes_amount = 0
+        taxes_surcharge = 0
+        taxes_used = {}
+        for tax in taxes:
+            if tax.tax.tax_kind == 'surcharge':
+                continue
+            related_tax = tax.tax.recargo_equivalencia_related_tax
+            surcharge = None
+            if related_tax:
+                surcharge = surcharges.get(
+                    (related_tax.id, tax.base.is_signed()))
+            lines.append((tax, surcharge))
+
+            base = tax.company_base
+            taxes_amount += tax.company_amount
+            if surcharge:
+                taxes_surcharge += surcharge.company_amount or 0
+            parent = tax.tax.parent if tax.tax.parent else tax.tax
+            if parent.id in taxes_used and base == taxes_used[parent.id]:
+                continue
+            taxes_base += base
+            taxes_used[parent.id] = base
+        return SimpleNamespace(
+            lines=lines,
+            cuota_total=taxes_amount,
+            importe_total=taxes_amount + taxes_base + taxes_surcharge)
+
+    @staticmethod
+    def verifactu_fingerprint(nif, number, invoice_date, operation_key,
+            cuota_total, importe_total, previous_fingerprint, generated):
+        # TODO: Review CuotaTotal as it is a string. How many digits are we using?
+        # TODO: The same for ImporteTotal
+        fingerprint_string = (
+            f'IDEmisorFactura={nif}&'
+            f'NumSerieFactura={number}&'
+            f'FechaExpedicionFactura={invoice_date.strftime("%d-%m-%Y")}&'
+            f'TipoFactura={operation_key}&'
+            f'CuotaTotal={cuota_total}&'
+            f'ImporteTotal={importe_total}&'
+            f'Huella={previous_fingerprint or ""}&'
+            f'FechaHoraHusoGenRegistro={generated}')
+        fingerprint_hash = hashlib.sha256(fingerprint_string.encode('utf-8'))
+        return fingerprint_hash.hexdigest().upper()
+
+    def verifactu_build_invoice(self, last_line=None, prefetched=None):
+        if prefetched:
+            nif = prefetched.nif
+            taxes = prefetched.taxes
+            identifier = prefetched.identifier
+        else:
+            nif = self.company.party.verifactu_vat_code
+            taxes = self.taxes
+            identifier = self.party_tax_identifier
+
+        breakdown = self.verifactu_tax_breakdown(taxes)
 
         def _build_encadenamiento(previous_line):
             if not previous_line:
@@ -671,9 +2049,14 @@ class Invoice(metaclass=PoolMeta):
                     'PrimerRegistro': 'S',
                     }
             previous_invoice = previous_line.invoice
+            if prefetched and previous_invoice.company == self.company:
+                previous_nif = nif
+            else:
+                previous_nif = (
+                    previous_invoice.company.party.verifactu_vat_code)
             return {
                 'RegistroAnterior': {
-                    'IDEmisorFactura': previous_invoice.company.party.verifactu_vat_code,
+                    'IDEmisorFactura': previous_nif,
                     'NumSerieFactura': previous_invoice.number,
                     'FechaExpedicionFactura': previous_invoice.invoice_date.strftime(
                         '%d-%m-%Y'),
@@ -682,7 +2065,7 @@ class Invoice(metaclass=PoolMeta):
 
         def _build_desglose():
             desgloses = []
-            for tax in verifactu_taxes():
+            for tax, surcharge in breakdown.lines:
                 desglose = {}
                 desglose['ClaveRegimen'] = tax.tax.verifactu_issued_key
                 if tax.tax.verifactu_subjected_key is not None:
@@ -692,17 +2075,11 @@ class Invoice(metaclass=PoolMeta):
                 else:
                     desglose['OperacionExenta'] = tax.tax.verifactu_exemption_cause
                 desglose['BaseImponibleOimporteNoSujeto'] = tax.company_base
-                if tax.tax.recargo_equivalencia_related_tax:
-                    for tax2 in self.taxes:
-                        if (tax2.tax.tax_kind == 'surcharge' and
-                                tax.tax.recargo_equivalencia_related_tax ==
-                                tax2.tax and tax2.base ==
-                                tax2.base.copy_sign(tax.base)):
-                            desglose['TipoRecargoEquivalencia'] = tools._rate_to_percent(
-                                tax2.tax.rate)
-                            desglose['CuotaRecargoEquivalencia'] = tax2.company_amount
-                            desglose['ClaveRegimen'] = 18 # Recargo de equivalencia
-                            break
+                if surcharge:
+                    desglose['TipoRecargoEquivalencia'] = tools._rate_to_percent(
+                        surcharge.tax.rate)
+                    desglose['CuotaRecargoEquivalencia'] = surcharge.company_amount
+                    desglose['ClaveRegimen'] = 18 # Recargo de equivalencia
                 desgloses.append(desglose)
             return desgloses
 
@@ -714,11 +2091,10 @@ class Invoice(metaclass=PoolMeta):
             vat = ''
             vat_type = None
             if not self.simplified:
-                identifier = self.party_tax_identifier
                 if identifier:
                     vat = identifier.es_code()
                     vat_type = identifier.es_vat_type()
-                    for tax in self.taxes:
+                    for tax in taxes:
                         if (tax.tax.verifactu_exemption_cause == 'E5' and
                                 vat_type != '02'):
                             raise UserError(gettext(
@@ -735,56 +2111,15 @@ class Invoice(metaclass=PoolMeta):
                 ret['NIF'] = vat
             return ret
 
-        def tax_equivalence_surcharge_amount(invoice_tax):
-            surcharge_tax = None
-            for invoicetax in invoice_tax.invoice.taxes:
-                if (invoicetax.tax.tax_kind == 'surcharge' and
-                        invoice_tax.tax.recargo_equivalencia_related_tax ==
-                        invoicetax.tax and invoicetax.base ==
-                        invoicetax.base.copy_sign(invoice_tax.base)):
-                    surcharge_tax = invoicetax
-                    break
-            if surcharge_tax:
-                return surcharge_tax.company_amount
-
-        def get_invoice_total():
-            taxes = [invoice_tax for invoice_tax in self.taxes if
-                not invoice_tax.tax.tax_kind == 'surcharge']
-            taxes_base = 0
-            taxes_amount = 0
-            taxes_surcharge = 0
-            taxes_used = {}
-            for tax in taxes:
-                base = tax.company_base
-                taxes_amount += tax.company_amount
-                taxes_surcharge += tax_equivalence_surcharge_amount(tax) or 0
-                parent = tax.tax.parent if tax.tax.parent else tax.tax
-                if (parent.id in list(taxes_used.keys()) and
-                        base == taxes_used[parent.id]):
-                    continue
-                taxes_base += base
-                taxes_used[parent.id] = base
-            return (taxes_amount + taxes_base + taxes_surcharge)
-
-
         tz = pytz.timezone('Europe/Madrid')
         dt_now = datetime.datetime.now(tz).replace(microsecond=0)
         formatted_now = dt_now.isoformat()
         previous_fingerprint = last_line.fingerprint if last_line else None
 
-        # TODO: Review CuotaTotal as it is a string. How many digits are we using?
-        # TODO: The same for ImporteTotal
-        fingerprint_string = (
-            f'IDEmisorFactura={self.company.party.verifactu_vat_code}&'
-            f'NumSerieFactura={self.number}&'
-            f'FechaExpedicionFactura={self.invoice_date.strftime("%d-%m-%Y")}&'
-            f'TipoFactura={self.verifactu_operation_key}&'
-            f'CuotaTotal={sum(tax.company_amount for tax in verifactu_taxes())}&'
-            f'ImporteTotal={get_invoice_total()}&'
-            f'Huella={previous_fingerprint or ""}&'
-            f'FechaHoraHusoGenRegistro={formatted_now}')
-        fingerprint_hash = hashlib.sha256(fingerprint_string.encode('utf-8'))
-        fingerprint_hash = fingerprint_hash.hexdigest().upper()
+        fingerprint_hash = self.verifactu_fingerprint(nif, self.number,
+            self.invoice_date, self.verifactu_operation_key,
+            breakdown.cuota_total, breakdown.importe_total,
+            previous_fingerprint, formatted_now)
 
         description = tools.unaccent(self.description or '')
         if not description:
@@ -793,7 +2128,7 @@ class Invoice(metaclass=PoolMeta):
         ret = {
             'IDVersion': '1.0',
             'IDFactura': {
-                'IDEmisorFactura': self.company.party.verifactu_vat_code,
+                'IDEmisorFactura': nif,
                 'NumSerieFactura': self.number,
                 'FechaExpedicionFactura': self.invoice_date.strftime('%d-%m-%Y'),
                 },
@@ -803,8 +2138,8 @@ class Invoice(metaclass=PoolMeta):
             'Desglose': {
                 'DetalleDesglose': _build_desglose(),
                 },
-            'CuotaTotal': sum(tax.company_amount for tax in verifactu_taxes()),
-            'ImporteTotal': get_invoice_total(),
+            'CuotaTotal': breakdown.cuota_total,
+            'ImporteTotal': breakdown.importe_total,
             'Encadenamiento': _build_encadenamiento(last_line),
             'SistemaInformatico': get_sistema_informatico(),
             'FechaHoraHusoGenRegistro':  formatted_now,
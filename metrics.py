@@ -0,0 +1,250 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import contextvars
+import datetime
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from logging import getLogger
+
+from lxml import etree
+from zeep import Plugin
+
+import trytond.config as config
+
+_logger = getLogger(__name__)
+
+# Metrics of the send_verifactu run being executed by the current context
+_current = contextvars.ContextVar('aeat_verifactu_metrics', default=None)
+# Callables receiving the Metrics of each finished run
+_hooks = []
+
+
+class Metrics:
+    "Timings, counters and payload sizes of a send_verifactu run"
+
+    def __init__(self, company=None):
+        self.company = company
+        self.start = datetime.datetime.now()
+        self.end = None
+        self.timings = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.sizes = defaultdict(int)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    @property
+    def duration(self):
+        end = self.end or datetime.datetime.now()
+        return (end - self.start).total_seconds()
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.timings[stage] += time.perf_counter() - start
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def add_size(self, name, size):
+        with self._lock:
+            self.sizes[name] += size
+
+    def set_value(self, name, value):
+        with self._lock:
+            self.values[name] = value
+
+    def stop(self):
+        if self.end is None:
+            self.end = datetime.datetime.now()
+
+    def summary(self):
+        with self._lock:
+            return {
+                'duration': self.duration,
+                'timings': dict(self.timings),
+                'counters': dict(self.counters),
+                'sizes': dict(self.sizes),
+                'values': dict(self.values),
+                }
+
+
+def current():
+    "Return the Metrics of the current run or None"
+    return _current.get()
+
+
+@contextmanager
+def activate(metrics):
+    "Make metrics the current ones of the context"
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+def finish(metrics):
+    "Stop metrics and pass them to the hooks"
+    metrics.stop()
+    for hook in list(_hooks):
+        try:
+            hook(metrics)
+        except Exception:
+            _logger.exception("Verifactu metrics hook %s failed", hook)
+
+
+@contextmanager
+def collect(company=None):
+    "Collect the metrics of a run and pass them to the hooks at the end"
+    metrics = Metrics(company)
+    try:
+        with activate(metrics):
+            yield metrics
+    finally:
+        finish(metrics)
+
+
+@contextmanager
+def timer(stage):
+    metrics = current()
+    if metrics is None:
+        yield
+    else:
+        with metrics.timer(stage):
+            yield
+
+
+def incr(name, value=1):
+    metrics = current()
+    if metrics is not None:
+        metrics.incr(name, value)
+
+
+def add_size(name, size):
+    metrics = current()
+    if metrics is not None:
+        metrics.add_size(name, size)
+
+
+def set_value(name, value):
+    metrics = current()
+    if metrics is not None:
+        metrics.set_value(name, value)
+
+
+def register_hook(hook):
+    if hook not in _hooks:
+        _hooks.append(hook)
+
+
+def unregister_hook(hook):
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+class MetricsPlugin(Plugin):
+    "Count the SOAP calls and the size of their serialized envelopes"
+
+    def egress(self, envelope, http_headers, operation, binding_options):
+        incr('soap_calls')
+        add_size('request_bytes', len(etree.tostring(envelope)))
+        return envelope, http_headers
+
+    def ingress(self, envelope, http_headers, operation):
+        add_size('response_bytes', len(etree.tostring(envelope)))
+        return envelope, http_headers
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+class PrometheusExporter:
+    '''
+    Accumulate the metrics of the runs by company and render them in the
+    Prometheus text format
+
+    When a path is set, the file is rewritten after each run so it can be
+    read by the textfile collector of the node exporter.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._runs = defaultdict(int)
+        self._seconds = defaultdict(float)
+        self._last_run = {}
+        self._timings = defaultdict(float)
+        self._counters = defaultdict(int)
+        self._sizes = defaultdict(int)
+
+    def __call__(self, metrics):
+        company = metrics.company
+        with self._lock:
+            self._runs[company] += 1
+            self._seconds[company] += metrics.duration
+            self._last_run[company] = metrics.end.timestamp()
+            for stage, value in metrics.timings.items():
+                self._timings[company, stage] += value
+            for name, value in metrics.counters.items():
+                self._counters[company, name] += value
+            for name, value in metrics.sizes.items():
+                self._sizes[company, name] += value
+        if self.path:
+            self.write()
+
+    def render(self):
+        lines = []
+
+        def metric(name, type_, help_, values):
+            lines.append('# HELP aeat_verifactu_%s %s' % (name, help_))
+            lines.append('# TYPE aeat_verifactu_%s %s' % (name, type_))
+            for labels, value in sorted(values, key=lambda v: v[0]):
+                labels = ','.join('%s="%s"' % (k, _escape(v))
+                    for k, v in labels)
+                lines.append('aeat_verifactu_%s{%s} %s' % (name, labels,
+                        value))
+
+        with self._lock:
+            metric('runs_total', 'counter', "Number of runs.",
+                [((('company', c),), v) for c, v in self._runs.items()])
+            metric('run_seconds_total', 'counter', "Duration of the runs.",
+                [((('company', c),), v) for c, v in self._seconds.items()])
+            metric('last_run_timestamp_seconds', 'gauge',
+                "End of the last run.",
+                [((('company', c),), v) for c, v in self._last_run.items()])
+            metric('stage_seconds_total', 'counter',
+                "Duration of the stages of the runs.",
+                [((('company', c), ('stage', s)), v)
+                    for (c, s), v in self._timings.items()])
+            metric('events_total', 'counter',
+                "Number of records and calls processed by the runs.",
+                [((('company', c), ('event', n)), v)
+                    for (c, n), v in self._counters.items()])
+            metric('payload_bytes_total', 'counter',
+                "Size of the SOAP envelopes exchanged.",
+                [((('company', c), ('payload', n)), v)
+                    for (c, n), v in self._sizes.items()])
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        # Write to a temporary file first so readers never see a partial file
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False,
+                suffix='.tmp') as f:
+            f.write(self.render())
+        os.replace(f.name, self.path)
+
+
+if config.get('aeat_verifactu', 'prometheus_file'):
+    register_hook(PrometheusExporter(
+            config.get('aeat_verifactu', 'prometheus_file')))
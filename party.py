@@ -3,6 +3,8 @@
 from trytond.model import fields
 from trytond.pool import PoolMeta
 
+from .invoice import headers_cache
+
 PARTY_IDENTIFIER_TYPE = [ # L7
     (None, 'VAT (for National operators)'),
     ('02', 'VAT (only for intracommunity operators)'),
@@ -25,6 +27,11 @@ class Party(metaclass=PoolMeta):
     verifactu_vat_code = fields.Function(fields.Char('Verifactu VAT Code', size=9),
         'get_verifactu_vat')
 
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        headers_cache.clear()
+
     def get_verifactu_vat(self, name=None):
         identifier = self.tax_identifier or (
             self.identifiers and self.identifiers[0])
@@ -35,3 +42,23 @@ class Party(metaclass=PoolMeta):
                         self.verifactu_identifier_type == '02'):
                     return identifier.code
                 return identifier.code[2:]
+
+
+class PartyIdentifier(metaclass=PoolMeta):
+    __name__ = 'party.identifier'
+
+    @classmethod
+    def create(cls, vlist):
+        identifiers = super().create(vlist)
+        headers_cache.clear()
+        return identifiers
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        headers_cache.clear()
+
+    @classmethod
+    def delete(cls, identifiers):
+        super().delete(identifiers)
+        headers_cache.clear()
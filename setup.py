@@ -105,8 +105,8 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         ],
     package_data={
         'trytond.modules.%s' % MODULE: (info.get('xml', [])
-            + ['tryton.cfg', 'locale/*.po', 'tests/*.rst', 'view/*.xml',
-            'icons/*.svg']),
+            + ['tryton.cfg', 'locale/*.po', 'tests/*.rst', 'tests/wsdl/*',
+            'view/*.xml', 'icons/*.svg']),
         },
     project_urls = {
        "Source Code": 'https://github.com:NaN-tic/trytond-aeat_verifactu.git'
@@ -129,6 +129,9 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         ],
     license='GPL-3',
     install_requires=requires,
+    extras_require={
+        'async': ['httpx'],
+        },
     dependency_links=dependency_links,
     zip_safe=False,
     entry_points="""
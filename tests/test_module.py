@@ -1,10 +1,21 @@
 # This file is part grau module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime
+from decimal import Decimal
 from types import SimpleNamespace
-from trytond.tests.test_tryton import ModuleTestCase
+import trytond.config as config
+from trytond import backend
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
 
-from trytond.modules.aeat_verifactu.invoice import Invoice
+from trytond.modules.aeat_verifactu import aeat_errors, metrics, tools
+from trytond.modules.account.tests import get_fiscalyear
+from trytond.modules.aeat_verifactu.invoice import (
+    Invoice, LeaseHeartbeat, period_send_invoices_cache)
+from trytond.modules.company.tests import create_company, set_company
 
 
 class GrauTestCase(ModuleTestCase):
@@ -42,4 +53,364 @@ class GrauTestCase(ModuleTestCase):
         self.assertEqual(records[1]['RegistroAlta']['PreviousFingerprint'], 'FP-1')
         self.assertEqual(records[1]['RegistroAlta']['PreviousInvoice'], 'INV/1')
 
+    def test_submit_records_matches_responses_by_id_factura(self):
+        def id_factura(number):
+            return {
+                'IDEmisorFactura': 'B00000000',
+                'NumSerieFactura': number,
+                'FechaExpedicionFactura': '01-01-2025',
+                }
+
+        calls = []
+
+        def register(headers, batch):
+            calls.append(len(batch))
+            # AEAT may answer in any order and skip some lines
+            return SimpleNamespace(RespuestaLinea=[{
+                        'IDFactura': record['RegistroAlta']['IDFactura'],
+                        'EstadoRegistro': 'Correcto',
+                        } for record in reversed(batch)
+                    if record['RegistroAlta']['IDFactura'][
+                        'NumSerieFactura'] != 'INV/2'])
+
+        service = SimpleNamespace(RegFactuSistemaFacturacion=register)
+        records = [{'RegistroAlta': {'IDFactura': id_factura(number)}}
+            for number in ['INV/1', 'INV/2', 'INV/3']]
+
+        responses, wait = Invoice.verifactu_submit_records(
+            service, {}, records)
+
+        self.assertEqual(calls, [3])
+        self.assertIsNone(wait)
+        self.assertEqual(
+            responses[('B00000000', 'INV/1', '01-01-2025')]['IDFactura'],
+            id_factura('INV/1'))
+        self.assertNotIn(('B00000000', 'INV/2', '01-01-2025'), responses)
+        self.assertIn(('B00000000', 'INV/3', '01-01-2025'), responses)
+
+    def test_chain_head_is_last_accepted_record(self):
+        def record(number):
+            return {'RegistroAlta': {
+                    'IDFactura': {
+                        'IDEmisorFactura': 'B00000000',
+                        'NumSerieFactura': number,
+                        'FechaExpedicionFactura': '01-01-2025',
+                        },
+                    'Huella': 'FP-' + number,
+                    }}
+
+        def response(number, state):
+            return {('B00000000', number, '01-01-2025'): {
+                    'EstadoRegistro': state}}
+
+        last_line = SimpleNamespace(invoice=None, fingerprint='FP-0')
+        invoices = ['INV/1', 'INV/2', 'INV/3']
+        records = [record(n) for n in invoices]
+
+        responses = {}
+        responses.update(response('INV/1', 'Correcto'))
+        responses.update(response('INV/2', 'AceptadoConErrores'))
+        responses.update(response('INV/3', 'Incorrecto'))
+        head = Invoice.verifactu_chain_head(
+            last_line, invoices, records, responses)
+        self.assertEqual(head.invoice, 'INV/2')
+        self.assertEqual(head.fingerprint, 'FP-INV/2')
+
+        self.assertIs(Invoice.verifactu_chain_head(
+                last_line, invoices, records,
+                response('INV/1', 'Incorrecto')), last_line)
+
+    def test_can_send(self):
+        now = datetime.datetime.now()
+        later = now + datetime.timedelta(seconds=60)
+        self.assertTrue(Invoice.verifactu_can_send(1, None))
+        self.assertTrue(Invoice.verifactu_can_send(
+                1, now - datetime.timedelta(seconds=1)))
+        self.assertFalse(Invoice.verifactu_can_send(999, later))
+        self.assertTrue(Invoice.verifactu_can_send(1000, later))
+
+    def test_error_codes(self):
+        self.assertEqual(dict(aeat_errors.AEAT_ERRORS)['3000'],
+            "Duplicate Invoice")
+        # Duplicate
+        self.assertFalse(aeat_errors.is_retryable('3000'))
+        # Already cancelled
+        self.assertFalse(aeat_errors.is_retryable('3001'))
+        # Not found
+        self.assertFalse(aeat_errors.is_retryable('3002'))
+        # Invalid value
+        self.assertTrue(aeat_errors.is_retryable('1100'))
+        self.assertTrue(aeat_errors.is_retryable(None))
+
+    def test_tax_breakdown_matches_surcharges_by_tax_and_sign(self):
+        surcharge = SimpleNamespace(id=2, tax_kind='surcharge', parent=None,
+            recargo_equivalencia_related_tax=None)
+        vat = SimpleNamespace(id=1, tax_kind='vat', parent=None,
+            recargo_equivalencia_related_tax=surcharge)
+
+        def line(tax, base, amount):
+            return SimpleNamespace(tax=tax, base=Decimal(base),
+                company_base=Decimal(base), company_amount=Decimal(amount))
+
+        vat_line = line(vat, '100', '21')
+        vat_credit_line = line(vat, '-50', '-10.50')
+        surcharge_credit_line = line(surcharge, '-50', '-2.60')
+        surcharge_line = line(surcharge, '100', '5.20')
+
+        breakdown = Invoice.verifactu_tax_breakdown([vat_line,
+                surcharge_credit_line, vat_credit_line, surcharge_line])
+
+        self.assertEqual(breakdown.lines, [
+                (vat_line, surcharge_line),
+                (vat_credit_line, surcharge_credit_line),
+                ])
+        self.assertEqual(breakdown.cuota_total, Decimal('10.50'))
+        self.assertEqual(breakdown.importe_total, Decimal('63.10'))
+
+    def test_fingerprint(self):
+        "Test the fingerprint with the example of the AEAT specification"
+        self.assertEqual(
+            Invoice.verifactu_fingerprint('89890001K', '12345678/G33',
+                datetime.date(2024, 1, 1), 'F1', Decimal('12.35'),
+                Decimal('123.45'), None, '2024-01-01T19:20:30+01:00'),
+            '3C464DAF61ACB827C65FDA19F352A4E3'
+            'BDC2C640E9E9FC4CC058073F38F12F60')
+
+    def test_metrics(self):
+        exporter = metrics.PrometheusExporter()
+        metrics.register_hook(exporter)
+        self.addCleanup(metrics.unregister_hook, exporter)
+
+        with metrics.collect(1) as run_metrics:
+            with metrics.timer('build'):
+                metrics.incr('records_sent', 2)
+            metrics.add_size('request_bytes', 100)
+        metrics.incr('records_sent')
+
+        summary = run_metrics.summary()
+        self.assertEqual(summary['counters'], {'records_sent': 2})
+        self.assertEqual(summary['sizes'], {'request_bytes': 100})
+        self.assertIn('build', summary['timings'])
+        self.assertIsNone(metrics.current())
+        text = exporter.render()
+        self.assertIn('aeat_verifactu_runs_total{company="1"} 1', text)
+        self.assertIn(
+            'aeat_verifactu_events_total{company="1",event="records_sent"} 2',
+            text)
+
+    def test_unaccent(self):
+        self.assertEqual(
+            tools.unaccent('Àngel Pérez/¿Sí?_S.L.'), 'Angel PerezSiS.L.')
+        self.assertEqual(
+            tools.unaccent('Comercial Ñandú, S.A.'), 'Comercial Nandu, S.A.')
+        self.assertEqual(tools.unaccent('Plain [name] #1'), 'Plain name 1')
+        self.assertEqual(
+            tools.unaccent_many(['Ñandú', 'a_b', 'Ñandú']),
+            ['Nandu', 'ab', 'Nandu'])
+
+    @with_transaction()
+    def test_lease(self):
+        "Test the lease of an issuer is exclusive until released or expired"
+        pool = Pool()
+        Lease = pool.get('aeat.verifactu.lease')
+        company = create_company()
+        nif = 'B00000000'
+
+        def expires():
+            lease, = Lease.search([
+                    ('company', '=', company),
+                    ('nif', '=', nif),
+                    ])
+            return Lease.read([lease.id], ['expires'])[0]['expires']
+
+        owner = Lease.acquire(company, nif)
+        self.assertTrue(owner)
+        self.assertIsNone(Lease.acquire(company, nif))
+        self.assertTrue(Lease.acquire(company, 'A00000000'))
+
+        expiration = expires()
+        self.assertTrue(Lease.renew(company, nif, owner))
+        self.assertGreaterEqual(expires(), expiration)
+        self.assertFalse(Lease.renew(company, nif, 'other'))
+
+        # An expired lease is taken by the next sender
+        lease, = Lease.search([
+                ('company', '=', company),
+                ('nif', '=', nif),
+                ])
+        Lease.write([lease], {
+                'expires': (
+                    datetime.datetime.now() - datetime.timedelta(seconds=1)),
+                })
+        other = Lease.acquire(company, nif)
+        self.assertTrue(other)
+        self.assertNotEqual(other, owner)
+        self.assertFalse(Lease.renew(company, nif, owner))
+
+        # Only the owner releases the lease
+        Lease.release(company, nif, owner)
+        self.assertIsNone(Lease.acquire(company, nif))
+        Lease.release(company, nif, other)
+        self.assertTrue(Lease.acquire(company, nif))
+
+    @with_transaction()
+    def test_lease_heartbeat(self):
+        "Test the heartbeat stops when the lease is lost"
+        calls = []
+
+        def call(method):
+            calls.append(method)
+            return len(calls) < 3
+
+        heartbeat = LeaseHeartbeat(1, 'B00000000', 'owner', 0.01)
+        heartbeat._call = call
+        heartbeat.start()
+        heartbeat.join(5)
+        self.assertFalse(heartbeat.is_alive())
+        self.assertTrue(heartbeat.lost)
+        with self.assertRaises(UserError):
+            heartbeat.check()
+        heartbeat.release()
+        self.assertEqual(calls, ['renew', 'renew', 'renew', 'release'])
+
+    @with_transaction()
+    def test_enqueue_send(self):
+        "Test the send of the posted invoices is queued once by issuer"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Chain = pool.get('aeat.verifactu.chain')
+        Queue = pool.get('ir.queue')
+        company = create_company()
+        other_company = create_company(
+            name='Other', currency=company.currency)
+
+        def tasks():
+            return {t.data['context']['company']: t for t in Queue.search([
+                        ('name', '=', 'verifactu'),
+                        ])}
+
+        invoices = [
+            SimpleNamespace(id=1, company=company),
+            SimpleNamespace(id=2, company=company),
+            ]
+
+        # Without workers the send would run when posting
+        Invoice.verifactu_enqueue_send(invoices)
+        self.assertEqual(tasks(), {})
+
+        config.set('queue', 'worker', 'True')
+        self.addCleanup(config.set, 'queue', 'worker', 'False')
+        if not config.has_section('aeat_verifactu'):
+            config.add_section('aeat_verifactu')
+        config.set('aeat_verifactu', 'send_on_post', 'False')
+        self.addCleanup(config.set, 'aeat_verifactu', 'send_on_post', 'True')
+        Invoice.verifactu_enqueue_send(invoices)
+        self.assertEqual(tasks(), {})
+
+        config.set('aeat_verifactu', 'send_on_post', 'True')
+        now = datetime.datetime.now()
+        Invoice.verifactu_enqueue_send(invoices)
+        task, = tasks().values()
+        self.assertEqual(task.data['method'], 'send_verifactu')
+        self.assertEqual(task.data['instances'], [1, 2])
+        self.assertGreaterEqual(
+            task.scheduled_at, now + datetime.timedelta(seconds=5))
+
+        # A waiting task sends the invoices posted later
+        Invoice.verifactu_enqueue_send(
+            [SimpleNamespace(id=3, company=company)])
+        self.assertEqual(list(tasks()), [company.id])
+
+        # The send waits for the wait time of AEAT
+        next_send = now + datetime.timedelta(minutes=10)
+        Chain.set_next_send(other_company, 'B00000000', next_send)
+        Invoice.verifactu_enqueue_send(
+            [SimpleNamespace(id=4, company=other_company)])
+        self.assertGreaterEqual(
+            tasks()[other_company.id].scheduled_at, next_send)
+
+    @with_transaction()
+    def test_cron_dispatch(self):
+        "Test the cron dispatches the companies at once"
+        pool = Pool()
+        Cron = pool.get('ir.cron')
+        Invoice = pool.get('account.invoice')
+        company = create_company()
+        other_company = create_company(
+            name='Other', currency=company.currency)
+        calls = []
+
+        def send_verifactu_companies(companies=None):
+            calls.append(companies)
+
+        original = Invoice.send_verifactu_companies
+        Invoice.send_verifactu_companies = send_verifactu_companies
+        self.addCleanup(setattr, Invoice, 'send_verifactu_companies',
+            original)
+
+        cron = Cron(method='account.invoice|send_verifactu_companies')
+        self.assertTrue(cron.on_change_with_company_needed())
+        cron.companies = [company, other_company]
+        cron.save()
+        Cron.run_once([cron])
+        self.assertEqual(calls, [[company.id, other_company.id]])
+
+    @with_transaction()
+    def test_period_send_invoices_cache(self):
+        "Test the flag of the periods clears the send invoices cache"
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+        Period = pool.get('account.period')
+        company = create_company()
+        with set_company(company):
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            FiscalYear.create_period([fiscalyear])
+            period = fiscalyear.periods[0]
+            key = (company.id, period.start_date.isoformat())
+
+            period_send_invoices_cache.set(key, False)
+            Period.write([period], {'es_verifactu_send_invoices': True})
+            self.assertIsNone(period_send_invoices_cache.get(key))
+
+            period_send_invoices_cache.set(key, True)
+            FiscalYear.write([fiscalyear], {
+                    'es_verifactu_send_invoices': False,
+                    })
+            self.assertIsNone(period_send_invoices_cache.get(key))
+
+    @with_transaction()
+    def test_verifactu_queries_have_index(self):
+        "Test an index can serve each Verifactu query"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Verifactu = pool.get('aeat.verifactu')
+        if backend.name != 'postgresql':
+            self.skipTest("The indexes are only checked on PostgreSQL")
+        cursor = Transaction().connection.cursor()
+        # With sequential scans disabled the planner still uses them when no
+        # index can serve the query. This does not check the plans chosen for
+        # the real data.
+        cursor.execute('SET LOCAL enable_seqscan = off')
+
+        queries = [
+            Invoice.search([('verifactu_state', '=', 'Incorrecto')],
+                order=[], query=True),
+            Invoice.search([('verifactu_to_send', '=', True)],
+                order=[], query=True),
+            Verifactu.search([('state', '=', 'Incorrecto')],
+                order=[], query=True),
+            Verifactu.search([('invoice', '=', 1)], query=True),
+            Verifactu.search([('error_code', '=', '3000')],
+                order=[], query=True),
+            *Invoice._verifactu_last_record_queries([1, 2]),
+            ]
+        for query in queries:
+            sql, params = tuple(query)
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(row[0] for row in cursor)
+            for table in ['account_invoice', 'aeat_verifactu']:
+                self.assertNotIn('Seq Scan on %s ' % table, plan,
+                    msg='%s\n%s' % (sql, plan))
+
 del ModuleTestCase
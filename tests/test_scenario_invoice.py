@@ -4,13 +4,21 @@ import unittest
 from trytond.tests.test_tryton import drop_db
 from trytond.tests.tools import activate_modules
 from trytond.exceptions import UserWarning
+import trytond.config as tconfig
 from tools import setup
+import verifactu_server
 
 class Test(unittest.TestCase):
 
     def setUp(self):
         drop_db()
         super().setUp()
+        # Send to the local stand-in of the AEAT service
+        self.server = verifactu_server.start(wait=0)
+        self.addCleanup(self.server.shutdown)
+        tconfig.set('aeat_verifactu', 'wsdl',
+            self.server.url + 'SistemaFacturacion.wsdl')
+        self.addCleanup(tconfig.set, 'aeat_verifactu', 'wsdl', '')
 
     def tearDown(self):
         drop_db()
@@ -83,6 +91,79 @@ class Test(unittest.TestCase):
         self.assertIn(invoice, invoices_to_send)
         invoices_not_to_send = Invoice.find([('verifactu_to_send', '=', False)])
         self.assertNotIn(invoice, invoices_not_to_send)
+        self.assertEqual(invoice.verifactu_last_record, None)
+        self.assertEqual(invoice.verifactu_last_state, None)
+        self.assertIn(invoice, Invoice.find([('verifactu_state', '=', None)]))
+
+        # The last record and its state follow each response of AEAT
+        Cron = Model.get('ir.cron')
+        cron, = Cron.find([
+                ('method', '=', 'account.invoice|send_verifactu'),
+                ])
+        self.server.error_rate = 1
+        cron.click('run_once')
+        invoice.reload()
+        rejected, = invoice.verifactu_records
+        self.assertEqual(invoice.verifactu_last_record, rejected)
+        self.assertEqual(invoice.verifactu_last_state, 'Incorrecto')
+        self.assertEqual(invoice.verifactu_state, 'Incorrecto')
+        self.assertEqual(rejected.error_code, '1100')
+        self.assertEqual(invoice.verifactu_to_send, True)
+        self.assertIn(invoice,
+            Invoice.find([('verifactu_state', '=', 'Incorrecto')]))
+        self.assertIn(invoice, Invoice.find([('verifactu_to_send', '=', True)]))
+
+        self.server.error_rate = 0
+        cron.click('run_once')
+        invoice.reload()
+        self.assertEqual(len(invoice.verifactu_records), 2)
+        accepted = max(invoice.verifactu_records, key=lambda r: r.id)
+        self.assertEqual(invoice.verifactu_last_record, accepted)
+        self.assertEqual(invoice.verifactu_last_state, 'Correcto')
+        self.assertEqual(invoice.verifactu_state, 'Correcto')
+        self.assertEqual(invoice.verifactu_to_send, False)
+        self.assertIn(invoice,
+            Invoice.find([('verifactu_state', '=', 'Correcto')]))
+        self.assertNotIn(invoice,
+            Invoice.find([('verifactu_state', '=', 'Incorrecto')]))
+        self.assertNotIn(invoice,
+            Invoice.find([('verifactu_to_send', '=', True)]))
+
+        # A duplicate is rejected for good
+        duplicate, = Invoice.duplicate([invoice])
+        duplicate.click('post')
+        self.server.keys.add((vars.company.party.verifactu_vat_code,
+                duplicate.number,
+                duplicate.invoice_date.strftime('%d-%m-%Y')))
+        cron.click('run_once')
+        duplicate.reload()
+        record, = duplicate.verifactu_records
+        self.assertEqual(duplicate.verifactu_last_record, record)
+        self.assertEqual(duplicate.verifactu_last_state, 'Incorrecto')
+        self.assertEqual(record.error_code, '3000')
+        self.assertEqual(duplicate.verifactu_to_send, False)
+        self.assertIn(duplicate,
+            Invoice.find([('verifactu_state', '=', 'Incorrecto')]))
+        self.assertNotIn(duplicate,
+            Invoice.find([('verifactu_to_send', '=', True)]))
+
+        # The last state follows the changes of the last record
+        Verifactu = Model.get('aeat.verifactu')
+        record.state = 'Correcto'
+        record.save()
+        duplicate.reload()
+        self.assertEqual(duplicate.verifactu_last_state, 'Correcto')
+        self.assertIn(duplicate,
+            Invoice.find([('verifactu_state', '=', 'Correcto')]))
+
+        # And the previous record becomes the last when it is deleted
+        Verifactu.delete([accepted])
+        invoice.reload()
+        self.assertEqual(invoice.verifactu_last_record, rejected)
+        self.assertEqual(invoice.verifactu_last_state, 'Incorrecto')
+        self.assertIn(invoice,
+            Invoice.find([('verifactu_state', '=', 'Incorrecto')]))
+        self.assertIn(invoice, Invoice.find([('verifactu_to_send', '=', True)]))
 
         revenue_journal, = Journal.find([('type', '=', 'revenue')], limit=1)
         revenue_journal.exclude_verifactu = True
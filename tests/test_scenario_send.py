@@ -0,0 +1,316 @@
+from proteus import Model
+from decimal import Decimal
+import datetime
+import unittest
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+import trytond.config as tconfig
+from tools import setup
+import verifactu_server
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+        # Send to the local stand-in of the AEAT service
+        self.server = verifactu_server.start(wait=0)
+        self.addCleanup(self.server.shutdown)
+        tconfig.set('aeat_verifactu', 'wsdl',
+            self.server.url + 'SistemaFacturacion.wsdl')
+        self.addCleanup(tconfig.set, 'aeat_verifactu', 'wsdl', '')
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def get_cron(self):
+        Cron = Model.get('ir.cron')
+        cron, = Cron.find([
+                ('method', '=', 'account.invoice|send_verifactu'),
+                ])
+        return cron
+
+    def create_product(self, vars):
+        ProductUom = Model.get('product.uom')
+        unit, = ProductUom.find([('name', '=', 'Unit')])
+        ProductTemplate = Model.get('product.template')
+        template = ProductTemplate()
+        template.name = 'product'
+        template.default_uom = unit
+        template.type = 'service'
+        template.list_price = Decimal('20')
+        template.account_category = vars.account_category
+        template.save()
+        product, = template.products
+        return product
+
+    def post_invoices(self, vars, product, count):
+        Invoice = Model.get('account.invoice')
+        invoices = []
+        for _ in range(count):
+            invoice = Invoice()
+            invoice.party = vars.party
+            invoice.type = 'out'
+            line = invoice.lines.new()
+            line.product = product
+            line.account = vars.accounts['revenue']
+            line.description = 'Test'
+            line.quantity = 1
+            line.unit_price = Decimal('10.0000')
+            invoice.click('post')
+            invoices.append(invoice)
+        return invoices
+
+    def test(self):
+        # Activate aeat_verifactu module
+        activate_modules(['aeat_verifactu'])
+
+        vars = setup()
+        nif = vars.company.party.verifactu_vat_code
+
+        product = self.create_product(vars)
+
+        # Post invoices
+        invoices = self.post_invoices(vars, product, 3)
+        for invoice in invoices:
+            self.assertEqual(invoice.verifactu_to_send, True)
+
+        # Send them with the cron
+        cron = self.get_cron()
+        cron.click('run_once')
+
+        for invoice in invoices:
+            invoice.reload()
+            self.assertEqual(invoice.verifactu_state, 'Correcto')
+            self.assertEqual(invoice.verifactu_to_send, False)
+        records = self.server.records[nif]
+        self.assertEqual([r['key'][1] for r in records],
+            [i.number for i in invoices])
+        self.assertEqual([r['huella'] for r in records],
+            [i.verifactu_last_record.fingerprint for i in invoices])
+        self.assertEqual(
+            self.server.calls['RegFactuSistemaFacturacion'], 1)
+
+        # The next invoice is chained to the local head without querying
+        # AEAT again
+        queries = self.server.calls.get('ConsultaFactuSistemaFacturacion')
+        invoice, = self.post_invoices(vars, product, 1)
+        cron.click('run_once')
+        invoice.reload()
+        self.assertEqual(invoice.verifactu_state, 'Correcto')
+        self.assertEqual(len(self.server.records[nif]), 4)
+        self.assertEqual(
+            self.server.calls.get('ConsultaFactuSistemaFacturacion'),
+            queries)
+
+    def test_chain_head(self):
+        "Test the chain head follows the last accepted record"
+        # Activate aeat_verifactu module
+        activate_modules(['aeat_verifactu'])
+
+        vars = setup()
+        nif = vars.company.party.verifactu_vat_code
+        product = self.create_product(vars)
+        cron = self.get_cron()
+        Chain = Model.get('aeat.verifactu.chain')
+
+        # AEAT already has records of the issuer sent by another system
+        today = datetime.date.today().strftime('%d-%m-%Y')
+        self.server.records[nif] = [{
+                'key': (nif, 'REMOTE/1', today),
+                'huella': 'FP-REMOTE-1',
+                'previous': None,
+                }, {
+                'key': (nif, 'REMOTE/2', today),
+                'huella': 'FP-REMOTE-2',
+                'previous': 'FP-REMOTE-1',
+                }]
+
+        # The first send adopts the last remote record as head
+        invoices = self.post_invoices(vars, product, 2)
+        cron.click('run_once')
+        records = self.server.records[nif]
+        self.assertEqual([r['previous'] for r in records[2:]],
+            ['FP-REMOTE-2', records[2]['huella']])
+        self.assertEqual(
+            self.server.calls['ConsultaFactuSistemaFacturacion'], 1)
+
+        invoice = invoices[-1]
+        invoice.reload()
+        head, = Chain.find([('nif', '=', nif)])
+        self.assertEqual(head.invoice, invoice)
+        self.assertEqual(head.number, invoice.number)
+        self.assertEqual(head.fingerprint,
+            invoice.verifactu_last_record.fingerprint)
+
+        # A rejected record does not move the head
+        self.server.error_rate = 1
+        rejected, = self.post_invoices(vars, product, 1)
+        cron.click('run_once')
+        rejected.reload()
+        self.assertEqual(rejected.verifactu_state, 'Incorrecto')
+        head.reload()
+        self.assertEqual(head.invoice, invoice)
+        self.assertEqual(head.fingerprint,
+            invoice.verifactu_last_record.fingerprint)
+
+        # The next accepted record is chained to the head and moves it
+        self.server.error_rate = 0
+        cron.click('run_once')
+        rejected.reload()
+        self.assertEqual(rejected.verifactu_state, 'Correcto')
+        records = self.server.records[nif]
+        self.assertEqual(records[-1]['previous'], records[-2]['huella'])
+        head.reload()
+        self.assertEqual(head.invoice, rejected)
+        self.assertEqual(head.fingerprint,
+            rejected.verifactu_last_record.fingerprint)
+        self.assertEqual(
+            self.server.calls['ConsultaFactuSistemaFacturacion'], 1)
+
+    def test_resume(self):
+        "Test an interrupted send resumes after the last batch saved"
+        tconfig.set('aeat_verifactu', 'batch_size', '2')
+        self.addCleanup(tconfig.set, 'aeat_verifactu', 'batch_size', '1000')
+
+        # Activate aeat_verifactu module
+        activate_modules(['aeat_verifactu'])
+
+        vars = setup()
+        nif = vars.company.party.verifactu_vat_code
+        product = self.create_product(vars)
+        invoices = self.post_invoices(vars, product, 5)
+
+        # AEAT fails after the first batch
+        self.server.fail_after = 1
+        cron = self.get_cron()
+        with self.assertRaises(Exception):
+            cron.click('run_once')
+
+        states = []
+        for invoice in invoices:
+            invoice.reload()
+            states.append(invoice.verifactu_state)
+        self.assertEqual(states, ['Correcto'] * 2 + [None] * 3)
+
+        # The next run sends the remaining invoices chained to the first
+        # batch
+        self.server.fail_after = None
+        cron.click('run_once')
+
+        for invoice in invoices:
+            invoice.reload()
+            self.assertEqual(invoice.verifactu_state, 'Correcto')
+        records = self.server.records[nif]
+        self.assertEqual([r['key'][1] for r in records],
+            [i.number for i in invoices])
+        self.assertEqual([r['previous'] for r in records],
+            [None] + [r['huella'] for r in records[:-1]])
+
+    @unittest.skipIf(httpx is None, "httpx is not installed")
+    def test_async(self):
+        "Test the asyncio send goes by rounds of a batch by issuer"
+        tconfig.set('aeat_verifactu', 'batch_size', '2')
+        self.addCleanup(tconfig.set, 'aeat_verifactu', 'batch_size', '1000')
+
+        # Activate aeat_verifactu module
+        activate_modules(['aeat_verifactu'])
+
+        vars = setup()
+        nif = vars.company.party.verifactu_vat_code
+        product = self.create_product(vars)
+        invoices = self.post_invoices(vars, product, 5)
+
+        Cron = Model.get('ir.cron')
+        cron = Cron()
+        cron.method = 'account.invoice|send_verifactu_companies_async'
+        cron.interval_number = 1
+        cron.interval_type = 'days'
+        cron.save()
+        cron.click('run_once')
+
+        for invoice in invoices:
+            invoice.reload()
+            self.assertEqual(invoice.verifactu_state, 'Correcto')
+        records = self.server.records[nif]
+        self.assertEqual([r['key'][1] for r in records],
+            [i.number for i in invoices])
+        self.assertEqual([r['previous'] for r in records],
+            [None] + [r['huella'] for r in records[:-1]])
+        self.assertEqual(
+            self.server.calls['RegFactuSistemaFacturacion'], 3)
+
+        VerifactuRun = Model.get('aeat.verifactu.run')
+        run, = VerifactuRun.find([])
+        self.assertEqual(run.state, 'done')
+        self.assertEqual(run.invoices_accepted, 5)
+
+        # The run is logged even if there is nothing to send
+        cron.click('run_once')
+        runs = VerifactuRun.find([], order=[('id', 'ASC')])
+        self.assertEqual(len(runs), 2)
+        self.assertEqual(runs[-1].state, 'done')
+        self.assertEqual(runs[-1].invoices_considered, 0)
+        self.assertEqual(
+            self.server.calls['RegFactuSistemaFacturacion'], 3)
+
+    def test_to_send(self):
+        "Test the search of the invoices to send matches their field"
+        # Activate aeat_verifactu module
+        activate_modules(['aeat_verifactu'])
+
+        vars = setup()
+        nif = vars.company.party.verifactu_vat_code
+        product = self.create_product(vars)
+        cron = self.get_cron()
+        Invoice = Model.get('account.invoice')
+
+        # Already accepted
+        accepted, = self.post_invoices(vars, product, 1)
+        cron.click('run_once')
+
+        # Duplicate
+        duplicate, = self.post_invoices(vars, product, 1)
+        self.server.keys.add((nif, duplicate.number,
+                duplicate.invoice_date.strftime('%d-%m-%Y')))
+        cron.click('run_once')
+
+        # Rejected and retryable
+        self.server.error_rate = 1
+        rejected, = self.post_invoices(vars, product, 1)
+        cron.click('run_once')
+
+        # Never sent
+        pending, = self.post_invoices(vars, product, 1)
+        draft = Invoice(party=vars.party, type='out')
+        draft.save()
+
+        invoices = [accepted, duplicate, rejected, pending, draft]
+        for invoice in invoices:
+            invoice.reload()
+        self.assertEqual(
+            [i.verifactu_state for i in invoices],
+            ['Correcto', 'Incorrecto', 'Incorrecto', None, None])
+        self.assertEqual(
+            [i.verifactu_last_record.error_code
+                if i.verifactu_last_record else None for i in invoices],
+            [None, '3000', '1100', None, None])
+
+        to_send = {i.id for i in invoices if i.verifactu_to_send}
+        self.assertEqual(to_send, {rejected.id, pending.id})
+        self.assertEqual(
+            {i.id for i in Invoice.find([('verifactu_to_send', '=', True)])},
+            to_send)
+        self.assertEqual(
+            {i.id for i in Invoice.find([('verifactu_to_send', '!=', False)])},
+            to_send)
+        self.assertEqual(
+            {i.id for i in Invoice.find([('verifactu_to_send', '=', False)])},
+            {i.id for i in invoices} - to_send)
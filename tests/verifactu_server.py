@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Local stand-in for the AEAT Verifactu SOAP service.
+
+The WSDL and schemas served are by default the reduced copies in tests/wsdl.
+They can be replaced by the AEAT ones, downloaded on a host with access to
+AEAT, with:
+
+    python tests/verifactu_server.py fetch DIRECTORY
+
+and then served, with the service addresses pointing to the stand-in, by:
+
+    python tests/verifactu_server.py serve --directory DIRECTORY --port 8080
+
+RegFactuSistemaFacturacion and ConsultaFactuSistemaFacturacion are answered
+from memory. The module uses the stand-in when the aeat_verifactu section
+of the trytond configuration contains:
+
+    wsdl = http://localhost:8080/SistemaFacturacion.wsdl
+"""
+import argparse
+import datetime
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urljoin, urlparse
+from urllib.request import urlopen
+
+from lxml import etree
+
+WSDL_URL = ('https://prewww2.aeat.es/static_files/common/internet/dep/'
+    'aplicaciones/es/aeat/tikeV1.0/cont/ws/SistemaFacturacion.wsdl')
+NS_BASE = ('https://www2.agenciatributaria.gob.es/static_files/common/'
+    'internet/dep/aplicaciones/es/aeat/tike/cont/ws/')
+NS_SOAP = 'http://schemas.xmlsoap.org/soap/envelope/'
+NS_WSDL_SOAP = 'http://schemas.xmlsoap.org/wsdl/soap/'
+NS_SF = NS_BASE + 'SuministroInformacion.xsd'
+NS_RESPONSE = NS_BASE + 'RespuestaSuministro.xsd'
+NS_QUERY_RESPONSE = NS_BASE + 'RespuestaConsultaLR.xsd'
+DIRECTORY = os.path.join(os.path.dirname(__file__), 'wsdl')
+# Maximum number of records which can be sent before the wait time
+MAX_RECORDS = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def fetch(directory, url=WSDL_URL):
+    "Download the WSDL and all the schemas it imports into directory"
+    os.makedirs(directory, exist_ok=True)
+    pending = [url]
+    done = set()
+    while pending:
+        url = pending.pop()
+        if url in done:
+            continue
+        done.add(url)
+        with urlopen(url) as response:
+            tree = etree.parse(response)
+        for element in tree.iter():
+            for attribute in ['schemaLocation', 'location']:
+                location = element.get(attribute)
+                if not location or element.tag == '{%s}address' % NS_WSDL_SOAP:
+                    continue
+                pending.append(urljoin(url, location))
+                element.set(attribute, os.path.basename(urlparse(location).path))
+        path = os.path.join(directory, os.path.basename(urlparse(url).path))
+        tree.write(path, xml_declaration=True, encoding='utf-8')
+        logger.info("saved %s", path)
+
+
+def _child(element, *path):
+    "Return the descendant following the local names of path"
+    for name in path:
+        if element is None:
+            return None
+        element = next((c for c in element
+                if isinstance(c.tag, str)
+                and etree.QName(c).localname == name), None)
+    return element
+
+
+def _text(element, *path):
+    element = _child(element, *path)
+    return element.text if element is not None else None
+
+
+def _iter(element, name):
+    return (e for e in element.iter()
+        if isinstance(e.tag, str) and etree.QName(e).localname == name)
+
+
+def _sub(parent, namespace, name, text=None):
+    element = etree.SubElement(parent, '{%s}%s' % (namespace, name))
+    if text is not None:
+        element.text = str(text)
+    return element
+
+
+def _id_factura(parent, namespace, name, key):
+    element = _sub(parent, namespace, name)
+    for tag, value in zip(
+            ['IDEmisorFactura', 'NumSerieFactura', 'FechaExpedicionFactura'],
+            key):
+        _sub(element, NS_SF, tag, value)
+    return element
+
+
+def _cabecera(parent, namespace, request):
+    "Add the Cabecera of the response for the issuer of request"
+    cabecera = _sub(parent, namespace, 'Cabecera')
+    _sub(cabecera, NS_SF, 'IDVersion', '1.0')
+    obligado = _sub(cabecera, NS_SF, 'ObligadoEmision')
+    for tag in ['NombreRazon', 'NIF']:
+        _sub(obligado, NS_SF, tag,
+            _text(request, 'Cabecera', 'ObligadoEmision', tag) or '')
+    return cabecera
+
+
+class Fault(Exception):
+    pass
+
+
+class VerifactuServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, directory=DIRECTORY, latency=0, jitter=0,
+            error_rate=0, fault_rate=0, wait=60, throttle=False,
+            page_size=10000, seed=None, fail_after=None):
+        super().__init__(address, VerifactuHandler)
+        self.directory = directory
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.fault_rate = fault_rate
+        self.wait = wait
+        self.throttle = throttle
+        self.page_size = page_size
+        # Number of submissions answered before failing all the next ones
+        self.fail_after = fail_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Accepted records by issuer NIF in submission order
+        self.records = {}
+        self.keys = set()
+        self.next_submission = {}
+        self.calls = {}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%s/' % (host, port)
+
+    def delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def register(self, request):
+        nif = _text(request, 'Cabecera', 'ObligadoEmision', 'NIF')
+        altas = list(_iter(request, 'RegistroAlta'))
+        now = time.monotonic()
+        with self.lock:
+            if self.fault_rate and self.random.random() < self.fault_rate:
+                raise Fault("Error técnico simulado")
+            if self.fail_after is not None:
+                if self.fail_after <= 0:
+                    raise Fault("Servicio no disponible")
+                self.fail_after -= 1
+            # The wait time only applies to incomplete submissions
+            if (self.throttle and len(altas) < MAX_RECORDS
+                    and now < self.next_submission.get(nif, 0)):
+                raise Fault("Envío realizado antes del tiempo de espera "
+                    "(%.0f s)" % (self.next_submission[nif] - now))
+            self.next_submission[nif] = now + self.wait
+
+            lines = []
+            for alta in altas:
+                key = (
+                    _text(alta, 'IDFactura', 'IDEmisorFactura'),
+                    _text(alta, 'IDFactura', 'NumSerieFactura'),
+                    _text(alta, 'IDFactura', 'FechaExpedicionFactura'),
+                    )
+                if key in self.keys and _text(alta, 'Subsanacion') != 'S':
+                    lines.append((key, 'Incorrecto', '3000',
+                            'Registro de facturación duplicado.'))
+                elif self.error_rate and self.random.random() < self.error_rate:
+                    lines.append((key, 'Incorrecto', '1100',
+                            'Valor o tipo incorrecto del campo: simulado'))
+                else:
+                    self.keys.add(key)
+                    self.records.setdefault(key[0], []).append({
+                            'key': key,
+                            'huella': _text(alta, 'Huella'),
+                            'previous': _text(alta, 'Encadenamiento',
+                                'RegistroAnterior', 'Huella'),
+                            })
+                    lines.append((key, 'Correcto', None, None))
+
+        states = {state for _, state, _, _ in lines}
+        if states == {'Correcto'}:
+            estado_envio = 'Correcto'
+        elif 'Correcto' in states:
+            estado_envio = 'ParcialmenteCorrecto'
+        else:
+            estado_envio = 'Incorrecto'
+
+        response = etree.Element('{%s}RespuestaRegFactuSistemaFacturacion'
+            % NS_RESPONSE, nsmap={'tikR': NS_RESPONSE, 'tik': NS_SF})
+        _sub(response, NS_RESPONSE, 'CSV', uuid.uuid4().hex[:16].upper())
+        _cabecera(response, NS_RESPONSE, request)
+        _sub(response, NS_RESPONSE, 'TiempoEsperaEnvio', self.wait)
+        _sub(response, NS_RESPONSE, 'EstadoEnvio', estado_envio)
+        for key, state, code, description in lines:
+            line = _sub(response, NS_RESPONSE, 'RespuestaLinea')
+            _id_factura(line, NS_RESPONSE, 'IDFactura', key)
+            operacion = _sub(line, NS_RESPONSE, 'Operacion')
+            _sub(operacion, NS_SF, 'TipoOperacion', 'Alta')
+            _sub(line, NS_RESPONSE, 'EstadoRegistro', state)
+            if code:
+                _sub(line, NS_RESPONSE, 'CodigoErrorRegistro', code)
+                _sub(line, NS_RESPONSE, 'DescripcionErrorRegistro',
+                    description)
+        return response
+
+    def query(self, request):
+        nif = _text(request, 'Cabecera', 'ObligadoEmision', 'NIF')
+        periodo = next(_iter(request, 'PeriodoImputacion'))
+        year = int(_text(periodo, 'Ejercicio'))
+        month = int(_text(periodo, 'Periodo'))
+        clave = next(_iter(request, 'ClavePaginacion'), None)
+        if clave is not None:
+            clave = (
+                _text(clave, 'IDEmisorFactura'),
+                _text(clave, 'NumSerieFactura'),
+                _text(clave, 'FechaExpedicionFactura'),
+                )
+
+        # AEAT returns the newest records first
+        with self.lock:
+            records = [r for r in reversed(self.records.get(nif, []))
+                if datetime.datetime.strptime(r['key'][2], '%d-%m-%Y'
+                    ).date().replace(day=1) == datetime.date(year, month, 1)]
+        if clave:
+            keys = [r['key'] for r in records]
+            start = keys.index(clave) + 1 if clave in keys else len(keys)
+            records = records[start:]
+        page = records[:self.page_size]
+        more = len(records) > self.page_size
+
+        ns = NS_QUERY_RESPONSE
+        response = etree.Element(
+            '{%s}RespuestaConsultaFactuSistemaFacturacion' % ns,
+            nsmap={'tikLRRC': ns, 'tik': NS_SF})
+        _cabecera(response, ns, request)
+        periodo = _sub(response, ns, 'PeriodoImputacion')
+        _sub(periodo, ns, 'Ejercicio', year)
+        _sub(periodo, ns, 'Periodo', str(month).zfill(2))
+        _sub(response, ns, 'IndicadorPaginacion', 'S' if more else 'N')
+        _sub(response, ns, 'ResultadoConsulta',
+            'ConDatos' if page else 'SinDatos')
+        for record in page:
+            registro = _sub(response, ns,
+                'RegistroRespuestaConsultaFactuSistemaFacturacion')
+            _id_factura(registro, ns, 'IDFactura', record['key'])
+            datos = _sub(registro, ns, 'DatosRegistroFacturacion')
+            _sub(datos, ns, 'Huella', record['huella'])
+            estado = _sub(registro, ns, 'EstadoRegistro')
+            _sub(estado, ns, 'EstadoRegistro', 'Correcta')
+        if more:
+            _id_factura(response, ns, 'ClavePaginacion', page[-1]['key'])
+        return response
+
+
+class VerifactuHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        name = os.path.basename(urlparse(self.path).path)
+        path = os.path.join(self.server.directory, name)
+        if not name or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        tree = etree.parse(path)
+        # Make every service port point to the stand-in
+        for address in tree.iter('{%s}address' % NS_WSDL_SOAP):
+            address.set('location', self.server.url + 'ws')
+        self._send(200, etree.tostring(tree, xml_declaration=True,
+                encoding='utf-8'))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        envelope = etree.fromstring(self.rfile.read(length))
+        request = _child(envelope, 'Body')[0]
+        operation = etree.QName(request).localname
+        self.server.delay()
+        with self.server.lock:
+            self.server.calls[operation] = (
+                self.server.calls.get(operation, 0) + 1)
+        try:
+            if operation == 'RegFactuSistemaFacturacion':
+                response = self.server.register(request)
+            elif operation == 'ConsultaFactuSistemaFacturacion':
+                response = self.server.query(request)
+            else:
+                raise Fault("Operación desconocida: %s" % operation)
+        except Fault as e:
+            status, body = 500, etree.Element('{%s}Fault' % NS_SOAP)
+            _sub(body, '', 'faultcode', 'env:Server')
+            _sub(body, '', 'faultstring', str(e))
+        else:
+            status, body = 200, response
+        result = etree.Element('{%s}Envelope' % NS_SOAP, nsmap={'env': NS_SOAP})
+        _sub(result, NS_SOAP, 'Body').append(body)
+        self._send(status, etree.tostring(result, xml_declaration=True,
+                encoding='utf-8'))
+
+    def _send(self, status, content):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def start(directory=DIRECTORY, host='localhost', port=0, **options):
+    "Start a stand-in in a background thread and return it"
+    server = VerifactuServer((host, port), directory, **options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fetch_parser = subparsers.add_parser('fetch',
+        help="download the AEAT WSDL and schemas")
+    fetch_parser.add_argument('directory')
+    fetch_parser.add_argument('--url', default=WSDL_URL)
+
+    serve_parser = subparsers.add_parser('serve', help="run the stand-in")
+    serve_parser.add_argument('--directory', default=DIRECTORY,
+        help="directory of the WSDL and schemas served")
+    serve_parser.add_argument('--host', default='localhost')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    serve_parser.add_argument('--latency', type=float, default=0,
+        help="seconds added to each request")
+    serve_parser.add_argument('--jitter', type=float, default=0,
+        help="maximum random seconds added to the latency")
+    serve_parser.add_argument('--error-rate', type=float, default=0,
+        help="ratio of records rejected")
+    serve_parser.add_argument('--fault-rate', type=float, default=0,
+        help="ratio of requests failing with a SOAP fault")
+    serve_parser.add_argument('--wait', type=int, default=60,
+        help="TiempoEsperaEnvio returned in seconds")
+    serve_parser.add_argument('--throttle', action='store_true',
+        help="reject incomplete submissions sent before the wait time")
+    serve_parser.add_argument('--page-size', type=int, default=10000,
+        help="records by page of ConsultaFactuSistemaFacturacion")
+    serve_parser.add_argument('--seed', type=int)
+    serve_parser.add_argument('--fail-after', type=int,
+        help="submissions answered before failing all the next ones")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'fetch':
+        fetch(args.directory, args.url)
+    else:
+        server = VerifactuServer((args.host, args.port), args.directory,
+            latency=args.latency, jitter=args.jitter,
+            error_rate=args.error_rate, fault_rate=args.fault_rate,
+            wait=args.wait, throttle=args.throttle,
+            page_size=args.page_size, seed=args.seed,
+            fail_after=args.fail_after)
+        logger.info("serving on %s", server.url)
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
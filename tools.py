@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import contextvars
 import unicodedata
+from functools import lru_cache
 from logging import getLogger
 from lxml import etree
+from requests import Session
 from zeep import Plugin
 
 
 src_chars = "/*+?Â¿!$[]{}@#`^:;<>=~%\\"
 dst_chars = "________________________"
+_unaccent_table = str.maketrans(
+    src_chars[:len(dst_chars)], dst_chars[:len(src_chars)])
 
 _logger = getLogger(__name__)
 
@@ -19,17 +24,28 @@ def normalize(text):
     return text
 
 
+@lru_cache(maxsize=4096)
 def unaccent(text):
-    output = text
-    for c in range(len(src_chars)):
-        if c >= len(dst_chars):
-            break
-        output = output.replace(src_chars[c], dst_chars[c])
-    output = unicodedata.normalize('NFKD', output).encode('ASCII',
-        'ignore')
+    output = text.translate(_unaccent_table)
+    if not output.isascii():
+        output = unicodedata.normalize('NFKD', output)
+    output = output.encode('ASCII', 'ignore')
     return output.replace(b"_", b"").decode('ASCII')
 
 
+def unaccent_many(texts):
+    "Return the unaccented version of each text in texts"
+    return [unaccent(text) for text in texts]
+
+
+def record_key(id_factura):
+    return (
+        id_factura['IDEmisorFactura'],
+        id_factura['NumSerieFactura'],
+        id_factura['FechaExpedicionFactura'],
+        )
+
+
 def format_period(period):
     return str(period).zfill(2)
 
@@ -38,6 +54,24 @@ def _rate_to_percent(rate):
     return None if rate is None else abs(round(100 * rate, 2))
 
 
+class CertificateSession(Session):
+    '''
+    Session using the client certificate set in the current context
+
+    A cached client can then be used at the same time by threads with
+    different temporary credentials.
+    '''
+    _cert = contextvars.ContextVar('aeat_verifactu_cert', default=None)
+
+    @property
+    def cert(self):
+        return self._cert.get()
+
+    @cert.setter
+    def cert(self, value):
+        self._cert.set(value)
+
+
 class LoggingPlugin(Plugin):
 
     def ingress(self, envelope, http_headers, operation):